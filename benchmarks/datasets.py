@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+import random
+
+from benchmarks.fake_discord import (
+    FakeClient,
+    FakeGuild,
+    FakeMessage,
+    FakeTextChannel,
+    FakeUser,
+)
+
+DISCORD_EPOCH_MS = 1420070400000
+START_MS = 1600000000000
+
+# Made-up two and three syllable words. The vocabulary has to be wide enough
+# that random messages rarely share a word shingle, or the near-duplicate
+# filter drops them and the crawl stores far fewer rows than it reads.
+SYLLABLES = "ba ce di fo gu ka le mi no pu ra se ti vo wa zu".split()
+WORDS = [first + second for first in SYLLABLES for second in SYLLABLES] + [
+    first + second + third
+    for first in SYLLABLES
+    for second in SYLLABLES
+    for third in SYLLABLES
+]
+
+
+@dataclass
+class DatasetSpec:
+    guilds: int = 2
+    channels: int = 5  # per guild
+    messages: int = 2000  # per channel
+    authors: int = 100  # per guild
+    seed: int = 0
+    page_latency: float = 0.0
+
+
+def snowflake(timestamp_ms: int, sequence: int) -> int:
+    return ((timestamp_ms - DISCORD_EPOCH_MS) << 22) | (sequence & 0xFFF)
+
+
+def generate_content(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+
+
+def generate_client(spec: DatasetSpec) -> FakeClient:
+    rng = random.Random(spec.seed)
+    guilds = []
+    user_id = 1
+    channel_id = 1
+    sequence = 0
+    for guild_index in range(spec.guilds):
+        guild = FakeGuild(10_000 + guild_index, f"guild-{guild_index}")
+        authors = []
+        for _ in range(spec.authors):
+            authors.append(FakeUser(user_id, f"user-{user_id}"))
+            user_id += 1
+        for channel_index in range(spec.channels):
+            channel = FakeTextChannel(
+                channel_id,
+                f"channel-{channel_index}",
+                guild,
+                page_latency=spec.page_latency,
+            )
+            channel_id += 1
+            timestamp_ms = START_MS
+            for _ in range(spec.messages):
+                timestamp_ms += rng.randint(1, 60_000)
+                sequence += 1
+                channel.messages.append(
+                    FakeMessage(
+                        snowflake(timestamp_ms, sequence),
+                        generate_content(rng),
+                        rng.choice(authors),
+                        guild,
+                        channel,
+                    )
+                )
+            guild.text_channels.append(channel)
+        guilds.append(guild)
+    return FakeClient(guilds)
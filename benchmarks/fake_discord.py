@@ -0,0 +1,83 @@
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+
+import discord
+
+PAGE_SIZE = 100  # messages per history request, as in the Discord API
+
+sent_message_ids = itertools.count(1)
+
+
+@dataclass(eq=False)
+class FakeUser:
+    id: int
+    name: str
+    bot: bool = False
+
+
+@dataclass(eq=False)
+class FakeGuild:
+    id: int
+    name: str
+    text_channels: list["FakeTextChannel"] = field(default_factory=list)
+
+
+@dataclass(eq=False)
+class FakeSentMessage:
+    content: str
+    view: discord.ui.View | None = None
+    id: int = field(default_factory=lambda: next(sent_message_ids))
+
+    async def edit(self, *, content: str | None = None, view=None):
+        if content is not None:
+            self.content = content
+        self.view = view
+
+
+@dataclass(eq=False)
+class FakeTextChannel:
+    # Stands in for discord.TextChannel: history() pages through an in-memory,
+    # id-sorted message list and send() only records what was sent.
+    id: int
+    name: str
+    guild: FakeGuild
+    messages: list["FakeMessage"] = field(default_factory=list)
+    page_latency: float = 0.0
+    sent: list[FakeSentMessage] = field(default_factory=list)
+
+    @property
+    def last_message_id(self) -> int | None:
+        return self.messages[-1].id if self.messages else None
+
+    async def history(self, limit=None, after=None, oldest_first=None):
+        after_id = after.id if after else 0
+        messages = [message for message in self.messages if message.id > after_id]
+        if not oldest_first:
+            messages.reverse()
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), PAGE_SIZE):
+            await asyncio.sleep(self.page_latency)
+            for message in messages[start : start + PAGE_SIZE]:
+                yield message
+
+    async def send(self, content: str, view: discord.ui.View | None = None):
+        sent_message = FakeSentMessage(content, view)
+        self.sent.append(sent_message)
+        return sent_message
+
+
+@dataclass(eq=False)
+class FakeMessage:
+    id: int
+    content: str
+    author: FakeUser
+    guild: FakeGuild
+    channel: FakeTextChannel
+
+
+@dataclass(eq=False)
+class FakeClient:
+    guilds: list[FakeGuild]
+    user: FakeUser = field(default_factory=lambda: FakeUser(0, "bench", bot=True))
@@ -0,0 +1,227 @@
+from dataclasses import asdict
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.datasets import DatasetSpec, generate_client, generate_content
+from benchmarks.fake_discord import FakeMessage, FakeUser
+from messagequizzer import message_handler
+from messagequizzer.backends import MemoryBackend, ShardedBackend, SingleFileBackend
+from messagequizzer.bot import on_message, outbound, question_store
+from messagequizzer.crawler import HistoryCrawler
+from messagequizzer.database import (
+    close_database,
+    guild_player_dao,
+    init_database,
+    message_dao,
+    mixed_author_dao,
+    use_backend,
+)
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+
+    def percentile(fraction: float) -> float:
+        index = min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))
+        return ordered[index] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def bench_ingest(client, crawler: HistoryCrawler) -> dict:
+    message_handler.start_flusher()
+    started = time.perf_counter()
+    progress = await crawler.crawl(client.guilds)
+    await message_handler.stop_flusher()
+    elapsed = time.perf_counter() - started
+    # Near-duplicates are read but not stored, so both counts are reported.
+    stored = 0
+    for guild in client.guilds:
+        stored += await message_dao.get_message_count_by_guild_id(guild.id)
+    return {
+        "messages": progress.messages_read,
+        "messages_stored": stored,
+        "channels": progress.channels_done,
+        "seconds": elapsed,
+        "messages_per_second": progress.messages_read / elapsed,
+    }
+
+
+async def bench_flush(client, size: int, rounds: int, rng: random.Random) -> dict:
+    guilds = client.guilds
+    next_id = max(
+        channel.last_message_id or 0
+        for guild in guilds
+        for channel in guild.text_channels
+    )
+    samples = []
+    for _ in range(rounds):
+        for _ in range(size):
+            next_id += 1
+            channel = rng.choice(rng.choice(guilds).text_channels)
+            author = rng.choice(channel.messages).author
+            message_handler.add_message(
+                FakeMessage(
+                    next_id, generate_content(rng), author, channel.guild, channel
+                )
+            )
+        started = time.perf_counter()
+        await message_handler.write_history()
+        samples.append(time.perf_counter() - started)
+    return {"messages_per_flush": size, **summarize(samples)}
+
+
+async def seed_games(client, rng: random.Random, answers: int):
+    # Scores and mixes for the leaderboard commands, written straight through
+    # the batch DAOs rather than simulated clicks.
+    player_deltas = []
+    mix_deltas = []
+    for guild in client.guilds:
+        authors = list(
+            {
+                message.author.id
+                for channel in guild.text_channels
+                for message in channel.messages
+            }
+        )
+        for _ in range(answers):
+            player_id = rng.choice(authors)
+            player_deltas.append(
+                (guild.id, player_id, f"player{player_id}", 1, rng.randint(1, 3))
+            )
+            correct_id, guessed_id = rng.sample(authors, 2)
+            mix_deltas.append((correct_id, guessed_id, 1))
+    await guild_player_dao.update_players(player_deltas)
+    await mixed_author_dao.increase_mixes(mix_deltas)
+
+
+async def bench_command(
+    client,
+    content: str,
+    iterations: int,
+    warmup: int,
+    rng: random.Random,
+    cached: bool,
+) -> dict:
+    samples = []
+    for iteration in range(warmup + iterations):
+        guild = rng.choice(client.guilds)
+        channel = rng.choice(guild.text_channels)
+        author = FakeUser(rng.randint(1 << 40, 1 << 41), "bench-player")
+        message = FakeMessage(0, content, author, guild, channel)
+        if not cached:
+            message_handler.clear_leaderboards()
+        started = time.perf_counter()
+        await on_message(message)
+        elapsed = time.perf_counter() - started
+        if iteration >= warmup:
+            samples.append(elapsed)
+        channel.sent.clear()
+    return summarize(samples)
+
+
+async def run(spec: DatasetSpec, args: argparse.Namespace) -> dict:
+    rng = random.Random(spec.seed)
+    client = generate_client(spec)
+    crawler = HistoryCrawler(progress_interval=3600)
+    # Fake channels have no rate limits, so replies are never held back.
+    outbound.channel_rate = outbound.global_window.rate = 1e9
+    results = {"dataset": asdict(spec), "backend": args.backend}
+
+    results["ingest"] = await bench_ingest(client, crawler)
+    results["flush"] = await bench_flush(client, args.flush_size, args.flush_rounds, rng)
+    await seed_games(client, rng, args.seed_answers)
+
+    commands = {}
+    for name, content, cached in [
+        ("guess", "!guess", False),
+        ("scores", "!scores", False),
+        ("scores_cached", "!scores", True),
+        ("mixes", "!mixes", False),
+        ("mixes_cached", "!mixes", True),
+    ]:
+        commands[name] = await bench_command(
+            client, content, args.iterations, args.warmup, rng, cached
+        )
+    results["commands"] = commands
+    await message_handler.question_queue.stop()
+    await question_store.stop()
+    await outbound.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot's hot paths against a synthetic dataset."
+    )
+    parser.add_argument("--guilds", type=int, default=DatasetSpec.guilds)
+    parser.add_argument("--channels", type=int, default=DatasetSpec.channels)
+    parser.add_argument("--messages", type=int, default=DatasetSpec.messages)
+    parser.add_argument("--authors", type=int, default=DatasetSpec.authors)
+    parser.add_argument("--seed", type=int, default=DatasetSpec.seed)
+    parser.add_argument(
+        "--page-latency",
+        type=float,
+        default=DatasetSpec.page_latency,
+        help="seconds each fake history page takes to arrive",
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--flush-size", type=int, default=5000)
+    parser.add_argument("--flush-rounds", type=int, default=5)
+    parser.add_argument("--seed-answers", type=int, default=2000)
+    parser.add_argument(
+        "--backend", choices=["file", "sharded", "memory"], default="file"
+    )
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    spec = DatasetSpec(
+        guilds=args.guilds,
+        channels=args.channels,
+        messages=args.messages,
+        authors=args.authors,
+        seed=args.seed,
+        page_latency=args.page_latency,
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        if args.backend == "sharded":
+            use_backend(ShardedBackend(directory))
+        elif args.backend == "memory":
+            use_backend(MemoryBackend())
+        else:
+            use_backend(SingleFileBackend(os.path.join(directory, "database.db")))
+        # The bot's progress prints would drown the results on stdout.
+        with contextlib.redirect_stdout(io.StringIO()):
+            init_database()
+            try:
+                results = asyncio.run(run(spec, args))
+            finally:
+                close_database()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import argparse
+import asyncio
+
+from messagequizzer.config import IMPORT_BATCH_SIZE, IMPORT_PROCESSES
+from messagequizzer.database import close_database, init_database
+from messagequizzer.importer import import_exports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import DiscordChatExporter JSON exports into the database."
+    )
+    parser.add_argument("paths", nargs="+", help="export files or directories")
+    parser.add_argument("--processes", type=int, default=IMPORT_PROCESSES)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    init_database()
+    try:
+        progress = asyncio.run(
+            import_exports(args.paths, args.processes, args.batch_size)
+        )
+    finally:
+        close_database()
+    print(f"Finished importing: {progress}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import random
+
+
+class AliasTable:
+    # Walker's alias method: O(n) to build from weights, then every draw is
+    # one uniform index and one coin flip, whatever the distribution.
+    __slots__ = ("items", "probabilities", "aliases")
+
+    def __init__(self, items: list[int], weights: list[float]):
+        count = len(items)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        self.items = items
+        self.probabilities = [1.0] * count
+        self.aliases = list(range(count))
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(large.pop())
+        # Whatever is left is 1.0 up to rounding and keeps its own item.
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def sample(self) -> int:
+        index = random.randrange(len(self.items))
+        if random.random() < self.probabilities[index]:
+            return self.items[index]
+        return self.items[self.aliases[index]]
@@ -0,0 +1,248 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Iterable, Iterator
+import asyncio
+import itertools
+import os
+import re
+import sqlite3
+
+from messagequizzer.config import *
+from messagequizzer.migrations import migrate
+from messagequizzer.storage import Storage
+
+GUILD_FILE = re.compile(r"guild-(\d+)\.db")
+memory_names = itertools.count()
+
+
+class StorageHandle:
+    # Stands for one guild storage of a backend, which may be closed and opened
+    # again between calls. Every call opens it off the event loop if needed and
+    # keeps it open until the call is done, so a handle can be held across
+    # awaits while the backend closes idle storages.
+    __slots__ = ("backend", "db_name")
+
+    def __init__(self, backend: "StorageBackend", db_name: str):
+        self.backend = backend
+        self.db_name = db_name
+
+    @asynccontextmanager
+    async def transaction(self):
+        storage = await self.backend.storage(self.db_name)
+        async with storage.transaction():
+            yield
+
+    async def write(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.write(fn, *args)
+
+    async def read(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.read(fn, *args)
+
+    async def execute(self, query: str, params: Iterable = ()) -> int:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.execute(query, params)
+
+    async def executemany(self, query: str, values: Iterable[Iterable]) -> int:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.executemany(query, values)
+
+    async def fetchone(self, query: str, params: Iterable = ()) -> tuple | None:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.fetchone(query, params)
+
+    async def fetchall(self, query: str, params: Iterable = ()) -> list[tuple]:
+        storage = await self.backend.storage(self.db_name)
+        return await storage.fetchall(query, params)
+
+
+class StorageBackend:
+    # Decides which storage holds what. Everything of one guild (its messages
+    # and their search index and duplicate buckets, GuildAuthors, channel
+    # checkpoints and GuildPlayers) lives in the storage of the guild, the
+    # rest in the shared one, and queries never join across the two. Every
+    # storage gets the whole schema, so a backend can put guilds anywhere.
+    shared: Storage
+
+    def open(self) -> None:
+        self.shared.open()
+        migrate(self.shared)
+
+    def close(self) -> None:
+        self.shared.close()
+
+    def guild(self, guild_id: int) -> Storage | StorageHandle:
+        raise NotImplementedError
+
+    def guild_storages(self) -> Iterator[Storage | StorageHandle]:
+        raise NotImplementedError
+
+    async def storage(self, name: str) -> Storage:
+        raise NotImplementedError
+
+    def use_writer_service(self, address: tuple[str, int], authkey: bytes):
+        # Only the shared storage is written through the writer service; guild
+        # storages belong to the process running the guild's shard.
+        self.shared.use_writer_service(address, authkey)
+
+
+class SingleFileBackend(StorageBackend):
+    def __init__(self, db_name: str):
+        self.shared = Storage(db_name)
+
+    def guild(self, guild_id: int) -> Storage:
+        return self.shared
+
+    def guild_storages(self) -> Iterator[Storage]:
+        yield self.shared
+
+
+class ShardedBackend(StorageBackend):
+    # One file per guild, or per hash shard of the guild ids, next to the
+    # shared file. Files are opened and migrated the first time a guild is
+    # used, and beyond max_open the least recently used idle ones are closed.
+    def __init__(
+        self,
+        directory: str,
+        shard_count: int | None = None,
+        max_open: int = STORAGE_MAX_OPEN,
+    ):
+        self.directory = directory
+        self.shard_count = shard_count
+        self.max_open = max_open
+        self.shared = Storage(os.path.join(directory, "shared.db"))
+        self.storages: OrderedDict[str, Storage] = OrderedDict()
+        self.opening: dict[str, asyncio.Future] = {}
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        super().open()
+
+    def close(self) -> None:
+        while self.storages:
+            self.storages.popitem()[1].close()
+        super().close()
+
+    def file_name(self, guild_id: int) -> str:
+        if self.shard_count is None:
+            return f"guild-{guild_id}.db"
+        # The low bits of a snowflake are a per-process counter; the timestamp
+        # spreads better.
+        return f"shard-{(guild_id >> 22) % self.shard_count}.db"
+
+    def guild(self, guild_id: int) -> StorageHandle:
+        return StorageHandle(self, self.file_name(guild_id))
+
+    def guild_storages(self) -> Iterator[StorageHandle]:
+        if self.shard_count is not None:
+            names = [f"shard-{shard}.db" for shard in range(self.shard_count)]
+        else:
+            names = sorted(
+                name
+                for name in os.listdir(self.directory)
+                if GUILD_FILE.fullmatch(name)
+            )
+        for name in names:
+            yield StorageHandle(self, name)
+
+    async def storage(self, name: str) -> Storage:
+        # Callers get an open storage and use it before awaiting anything
+        # else, which is what keeps close_idle away from it.
+        storage = self.storages.get(name)
+        while storage is None or not storage.is_open:
+            # Concurrent calls for a file that is being opened share the open;
+            # it may be closed as idle again before this caller resumes.
+            opening = self.opening.get(name)
+            if opening is None or opening.done():
+                opening = asyncio.ensure_future(self.open_storage(name))
+                self.opening[name] = opening
+                opening.add_done_callback(lambda _: self.opening.pop(name, None))
+            storage = await asyncio.shield(opening)
+        self.storages.move_to_end(name)
+        self.close_idle()
+        return storage
+
+    async def open_storage(self, name: str) -> Storage:
+        storage = Storage(
+            os.path.join(self.directory, name),
+            read_connections=2,
+            cache_size_kib=8 * 1024,
+        )
+        # Opening a file, and migrating a new one, blocks; not on the loop.
+        try:
+            await asyncio.to_thread(open_and_migrate, storage)
+        except BaseException:
+            storage.close()
+            raise
+        self.storages[name] = storage
+        return storage
+
+    def close_idle(self) -> None:
+        # Busy storages stay open past max_open, and so does the most recently
+        # used one, which its caller is about to use.
+        excess = len(self.storages) - self.max_open
+        if excess <= 0:
+            return
+        for name, storage in list(self.storages.items())[:-1]:
+            if excess <= 0:
+                return
+            if storage.is_idle:
+                del self.storages[name]
+                storage.close()
+                excess -= 1
+
+
+class MemoryBackend(StorageBackend):
+    # Nothing touches the disk and everything is gone once closed, for tests
+    # and benchmarks. Guilds get their own database like with the sharded
+    # backend, so both take the same paths.
+    def __init__(self):
+        self.prefix = f"messagequizzer-{os.getpid()}-{next(memory_names)}"
+        self.shared = Storage(
+            f"{self.prefix}-shared", read_connections=2, memory=True
+        )
+        self.storages: dict[str, Storage] = {}
+        self.opening: dict[str, asyncio.Future] = {}
+
+    def close(self) -> None:
+        while self.storages:
+            self.storages.popitem()[1].close()
+        super().close()
+
+    def guild(self, guild_id: int) -> StorageHandle:
+        return StorageHandle(self, f"guild-{guild_id}")
+
+    def guild_storages(self) -> Iterator[StorageHandle]:
+        for name in list(self.storages):
+            yield StorageHandle(self, name)
+
+    async def storage(self, name: str) -> Storage:
+        storage = self.storages.get(name)
+        if storage is not None:
+            return storage
+        opening = self.opening.get(name)
+        if opening is None:
+            opening = asyncio.ensure_future(self.open_storage(name))
+            self.opening[name] = opening
+            opening.add_done_callback(lambda _: self.opening.pop(name, None))
+        return await asyncio.shield(opening)
+
+    async def open_storage(self, name: str) -> Storage:
+        storage = Storage(f"{self.prefix}-{name}", read_connections=2, memory=True)
+        await asyncio.to_thread(open_and_migrate, storage)
+        self.storages[name] = storage
+        return storage
+
+
+def open_and_migrate(storage: Storage) -> None:
+    storage.open()
+    migrate(storage)
+
+
+def create_backend(db_name: str) -> StorageBackend:
+    if STORAGE_BACKEND == "sharded":
+        return ShardedBackend(STORAGE_DIRECTORY, STORAGE_SHARDS)
+    if STORAGE_BACKEND == "memory":
+        return MemoryBackend()
+    return SingleFileBackend(db_name)
@@ -1,152 +1,188 @@
-from discord.emoji import Emoji
 from discord.enums import ButtonStyle
 
 from discord.interactions import Interaction
-from discord.partial_emoji import PartialEmoji
 from messagequizzer.config import *
+from messagequizzer.crawler import crawler
 from messagequizzer.message_handler import *
-
+from messagequizzer.metrics import (
+    COMMAND_LATENCY,
+    QUERIES,
+    label_key,
+    registry,
+    start_metrics_server,
+)
+from messagequizzer.outbound import OutboundScheduler
+from messagequizzer.questions import QuestionStore
+
+import asyncio
 import discord
-import random
+import time
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = discord.Client(intents=intents)
 
+class QuizClient(discord.AutoShardedClient):
+    # Runs every shard in this process unless shard_ids is set, in which case
+    # other processes run the rest and share the database via a writer service.
+    metrics_port: int | None = METRICS_PORT
+    metrics_server: asyncio.Server | None = None
+
+    async def setup_hook(self):
+        start_flusher()
+        game_events.start()
+        retention.start(lambda: [guild.id for guild in self.guilds])
+        await question_store.start(self.shard_ids, self.shard_count)
+        if self.metrics_port is not None:
+            self.metrics_server = await start_metrics_server(
+                METRICS_HOST, self.metrics_port
+            )
 
-@bot.event
-async def on_ready():
-    print(f"Logged in as {bot.user}")
+    async def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        await crawler.stop()
+        await retention.stop()
+        await question_queue.stop()
+        # Closing edits of expiring questions still go out through outbound.
+        await question_store.stop()
+        await outbound.stop()
+        await game_events.stop()
+        await stop_flusher()
+        await super().close()
 
-    print("Catching up!\n")
-    for guild in bot.guilds:
-        for channel in guild.text_channels:
-            print(f"Checking #{channel.name} of {guild.name}")
-            try:
-                await read_history(channel)
-            except discord.Forbidden:
-                pass
-        print(f"Finished read initialization {guild}!\n")
-    print("Finished read initialization!")
 
+bot = QuizClient(intents=intents, max_ratelimit_timeout=MAX_RATELIMIT_TIMEOUT)
 
-@bot.event
-async def on_guild_join(guild: discord.Guild):
-    for channel in guild.text_channels:
-        print(f"Checking #{channel.name} of {guild.name}")
-        try:
-            await read_history(channel)
-        except discord.Forbidden:
-            pass
-    print(f"Finished read initialization {guild}!")
-
-
-class QuestionButton(discord.ui.Button):
-    def __init__(
-        self,
-        on_callback,
-        author: Author,
-        *,
-        style: ButtonStyle = ButtonStyle.secondary,
-        label: str | None = None,
-        disabled: bool = False,
-        custom_id: str | None = None,
-        url: str | None = None,
-        emoji: str | Emoji | PartialEmoji | None = None,
-        row: int | None = None,
-    ):
-        if not label:
-            label = author.name
-        super().__init__(
-            style=style,
-            label=label,
-            disabled=disabled,
-            custom_id=custom_id,
-            url=url,
-            emoji=emoji,
-            row=row,
-        )
-        self.author = author
-        self.on_callback = on_callback
+COMMANDS = {GUESS_COMMAND, SCOREBOARD_COMMAND, MIXES_COMMAND, STATS_COMMAND}
 
-    async def callback(self, interaction: Interaction):
-        await self.on_callback(self.author, interaction)
-        return await super().callback(interaction)
 
+@bot.event
+async def on_ready():
+    print(f"Logged in as {bot.user}")
 
-class QuestionView(discord.ui.View):
-    def __init__(self, message: Message, *, timeout: float | None = 180):
-        super().__init__(timeout=timeout)
 
-        self.correct_author = get_author(message)
-        self.winners = set()
-        self.tries = defaultdict(int)
+@bot.event
+async def on_shard_ready(shard_id: int):
+    # Commands are served from the stored history right away; each shard
+    # catches up on its own guilds in the background.
+    guilds = [guild for guild in bot.guilds if guild.shard_id == shard_id]
+    print(f"Shard {shard_id} serving {len(guilds)} guilds, catching up!\n")
+    crawler.start(guilds)
 
-        authors = guild_author_dao.get_authors_by_guild(message.guild_id)
 
-        authors = [
-            author
-            for author in authors
-            if author.author_id != self.correct_author.author_id
-        ]
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    crawler.start([guild])
 
-        chosen_authors = random.sample(
-            authors, k=min(NUMBER_OF_FALSE_ANSWERS, len(authors))
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    crawler.cancel_guild(guild.id)
+    forget_guild(guild.id)
+
+
+def build_question_view(choices: list[Author]) -> discord.ui.View:
+    # Only used to send the buttons; answers are routed by custom_id in
+    # on_interaction, so no view object is kept per question.
+    view = discord.ui.View(timeout=None)
+    for author in choices:
+        view.add_item(
+            discord.ui.Button(
+                style=ButtonStyle.secondary,
+                label=author.name,
+                custom_id=f"{QUESTION_BUTTON_PREFIX}{author.author_id}",
+            )
+        )
+    view.stop()
+    return view
+
+
+async def close_question(question: OpenQuestion):
+    message = bot.get_partial_messageable(question.channel_id).get_partial_message(
+        question.message_id
+    )
+    try:
+        await outbound.edit(
+            message,
+            content=f"{question.content}\n-||`{question.correct_author.name.ljust(MAX_NAME_LENGTH)}`||",
+            view=None,
         )
-        chosen_authors.append(self.correct_author)
+    except discord.HTTPException as exception:
+        # Deleted messages and channels the bot lost access to.
+        print(f"Could not close question {question.message_id}: {exception!r}")
 
-        random.shuffle(chosen_authors)
 
-        for author in chosen_authors:
-            self.add_item(QuestionButton(self.on_button_callback, author=author))
+outbound = OutboundScheduler()
+question_store = QuestionStore(question_dao, close_question)
+ACTIVE_QUESTIONS = registry.gauge(
+    "messagequizzer_active_questions",
+    "Questions that have not timed out yet.",
+    lambda: len(question_store),
+)
+OUTBOUND_QUEUED = registry.gauge(
+    "messagequizzer_outbound_queued",
+    "Replies, announcement messages and edits waiting to be sent.",
+    lambda: len(outbound),
+)
 
-    def set_sent_message(self, message: discord.Message):
-        self.sent_message = message
 
-    async def on_timeout(self):
-        await self.sent_message.edit(
-            content=f"{self.sent_message.content}\n-||`{self.correct_author.name.ljust(MAX_NAME_LENGTH)}`||",
-            view=None,
+@bot.event
+async def on_interaction(interaction: Interaction):
+    if interaction.type != discord.InteractionType.component:
+        return
+    custom_id = (interaction.data or {}).get("custom_id", "")
+    if custom_id.startswith(QUESTION_BUTTON_PREFIX):
+        await answer_question(
+            interaction, int(custom_id.removeprefix(QUESTION_BUTTON_PREFIX))
         )
-        return await super().on_timeout()
 
-    async def on_button_callback(
-        self, clicked_author: Author, interaction: Interaction
-    ):
-        if interaction.user in self.winners:
-            await interaction.response.defer()
-            return
-        if clicked_author.name == self.correct_author.name:
-            message_content: str
-            if interaction.user.id not in self.tries:
-                message_content = f"{interaction.user.name} got the answer first try!"
-                await player_dao.update_player(interaction.user.id, 1)
-            else:
-                await player_dao.update_player(
-                    interaction.user.id, self.tries[interaction.user.id] + 1
-                )
-                if self.tries[interaction.user.id] == 1:
-                    message_content = (
-                        f"{interaction.user.name} got the answer second try!"
-                    )
-                elif self.tries[interaction.user.id] <= NUMBER_OF_FALSE_ANSWERS:
-                    message_content = f"{interaction.user.name} got the answer after {self.tries[interaction.user.id]} tries!"
-                else:
-                    message_content = f"{interaction.user.name} got the answer after {self.tries[interaction.user.id]} tries..."
-            await interaction.response.send_message(
-                content=message_content,
-            )
-            self.winners.add(interaction.user)
 
+async def answer_question(interaction: Interaction, clicked_id: int):
+    question = await question_store.get(interaction.message.id)
+    clicked_author = None
+    if question is not None:
+        clicked_author = next(
+            (author for author in question.choices if author.author_id == clicked_id),
+            None,
+        )
+    if clicked_author is None:
+        await interaction.response.send_message(
+            content="This question is over!", ephemeral=True
+        )
+        return
+    attempt = question_store.get_attempt(question.message_id, interaction.user.id)
+    if attempt.solved:
+        await interaction.response.defer()
+        return
+    if clicked_author.author_id == question.correct_id:
+        attempt.solved = True
+        await record_answer(
+            question.guild_id,
+            interaction.user.id,
+            interaction.user.name,
+            attempt.tries + 1,
+        )
+        if attempt.tries == 0:
+            message_content = f"{interaction.user.name} got the answer first try!"
+        elif attempt.tries == 1:
+            message_content = f"{interaction.user.name} got the answer second try!"
+        elif attempt.tries <= NUMBER_OF_FALSE_ANSWERS:
+            message_content = f"{interaction.user.name} got the answer after {attempt.tries} tries!"
         else:
-            self.tries[interaction.user.id] += 1
-            await mixed_author_dao.increase_mix(
-                self.correct_author.author_id, clicked_author.author_id
-            )
-            await interaction.response.send_message(
-                content=f"It was not {clicked_author.name}!", ephemeral=True
-            )
+            message_content = f"{interaction.user.name} got the answer after {attempt.tries} tries..."
+        # Announcements of a busy channel are merged into one message.
+        await interaction.response.defer()
+        outbound.announce(interaction.channel, message_content)
+    else:
+        attempt.tries += 1
+        record_mix(question.guild_id, question.correct_id, clicked_author.author_id)
+        await interaction.response.send_message(
+            content=f"It was not {clicked_author.name}!", ephemeral=True
+        )
+    record_attempt(
+        question.message_id, interaction.user.id, attempt.tries, attempt.solved
+    )
 
 
 @bot.event
@@ -154,52 +190,105 @@ async def on_message(message: discord.Message):
     if message.author.bot:
         return
 
-    if should_write_history():
-        await write_history()
-
+    with COMMAND_LATENCY.time(command=get_command_label(message.content)):
+        await handle_message(message)
+
+
+def get_command_label(content: str) -> str:
+    if content in COMMANDS:
+        return content
+    if get_guess_keyword(content):
+        return f"{GUESS_COMMAND} <keyword>"
+    return "other_command" if content.startswith("!") else "message"
+
+
+def format_stats() -> str:
+    uptime = time.time() - registry.started_at
+    content = "# Stats\n`"
+    content += f"{'Uptime'.ljust(22)} {uptime:.0f}s\n"
+    for kind in ("read", "write", "transaction"):
+        queries = QUERIES.values.get(label_key({"kind": kind}), 0)
+        content += f"{f'Queries ({kind})'.ljust(22)} {queries:.0f}\n"
+    content += f"{'Pending messages'.ljust(22)} {PENDING_MESSAGES.value():.0f}\n"
+    content += f"{'Pending KiB'.ljust(22)} {PENDING_BYTES.value() / 1024:.0f}\n"
+    content += f"{'Active questions'.ljust(22)} {ACTIVE_QUESTIONS.value():.0f}\n"
+    content += f"{'Outbound queued'.ljust(22)} {OUTBOUND_QUEUED.value():.0f}\n"
+    content += f"\n{'Command'.ljust(22)} {'Count'.rjust(8)} {'Mean ms'.rjust(8)} {'p99 ms'.rjust(8)}\n"
+    for labels in COMMAND_LATENCY.label_sets():
+        count = COMMAND_LATENCY.count(**labels)
+        mean = COMMAND_LATENCY.mean(**labels) * 1000
+        p99 = COMMAND_LATENCY.quantile(0.99, **labels) * 1000
+        content += f"{labels['command'].ljust(22)} {str(count).rjust(8)} {f'{mean:.1f}'.rjust(8)} {f'{p99:.1f}'.rjust(8)}\n"
+    return content + "`"
+
+
+def get_guess_keyword(content: str) -> str | None:
+    command, _, keyword = content.partition(" ")
+    if command != GUESS_COMMAND or not any(char.isalnum() for char in keyword):
+        return None
+    return keyword.strip()
+
+
+async def handle_message(message: discord.Message):
     if is_message_qualified(message):
-        add_message(message, False)
+        add_message(message)
 
+    keyword = get_guess_keyword(message.content)
     if not message.content.startswith("!"):
         return
-    elif message.content == GUESS_COMMAND:
-        question_message = get_random_message(message.guild.id)
-        if question_message:
-            view = QuestionView(question_message)
-            sent_message = await message.channel.send(
-                content=question_message.content, view=view
+    elif message.content == GUESS_COMMAND or keyword:
+        # Keyword questions are too varied to prefetch.
+        if keyword is None:
+            question = await question_queue.pop(message.guild.id)
+        else:
+            question = await prepare_question(message.guild.id, keyword)
+        if question:
+            sent_message = await outbound.send(
+                message.channel,
+                content=question.message.content,
+                view=build_question_view(question.choices),
+            )
+            await question_store.open(
+                OpenQuestion(
+                    sent_message.id,
+                    message.channel.id,
+                    message.guild.id,
+                    question.correct_author.author_id,
+                    question.message.content,
+                    question.choices,
+                    time.time() + QUESTION_TIMEOUT,
+                )
+            )
+        elif crawler.is_catching_up(message.guild.id):
+            await outbound.send(
+                message.channel,
+                content="The bot is still reading this server's messages, try again soon!",
+            )
+        elif keyword is not None:
+            await outbound.send(
+                message.channel, content="The bot hasn't read any messages about that!"
             )
-            view.set_sent_message(sent_message)
         else:
-            await message.channel.send(
-                content="The bot still hasn't read this server's messages enough!"
+            await outbound.send(
+                message.channel,
+                content="The bot still hasn't read this server's messages enough!",
             )
     elif message.content == SCOREBOARD_COMMAND:
         content = f"# Scoreboard\n`{'Name'.ljust(MAX_NAME_LENGTH)} Avg Guess\n"
 
-        for player in sorted(
-            player_dao.get_all_players_by_guild_ascending_by_avg_guess_by_score(
-                message.guild.id, 10
-            ),
-            key=lambda player: player.total_tries / player.score,
-        ):
-            author = author_dao.get_author_by_id(player.player_id)
-            name = author.name
-            score = player.total_tries / player.score
-            content += f"{name.ljust(MAX_NAME_LENGTH)} {f'{score:.2f}'.rjust(len('Avg Guess'))}\n"
-
-        await message.channel.send(content=content + "`")
+        for entry in await get_scoreboard(message.guild.id):
+            content += f"{entry.name.ljust(MAX_NAME_LENGTH)} {f'{entry.average_guess:.2f}'.rjust(len('Avg Guess'))}\n"
+
+        await outbound.send(message.channel, content=content + "`")
     elif message.content == MIXES_COMMAND:
         content = f"# Most Mixed Users\n`{'Correct User'.ljust(MAX_NAME_LENGTH)} {'Guessed User'.ljust(MAX_NAME_LENGTH)} Count\n"
 
-        for mix in sorted(
-            mixed_author_dao.get_all_mixes_by_guild_descending_by_times(
-                message.guild.id, 10
-            ),
-            key=lambda mix: mix.times,
-        )[::-1]:
-            correct_author = author_dao.get_author_by_id(mix.correct_id)
-            guessed_author = author_dao.get_author_by_id(mix.guessed_id)
-            content += f"{correct_author.name.ljust(MAX_NAME_LENGTH)} {guessed_author.name.ljust(MAX_NAME_LENGTH)} {str(mix.times).rjust(len('Count'))}\n"
-
-        await message.channel.send(content=content + "`")
+        for mix in await get_mix_board(message.guild.id):
+            content += f"{mix.correct_name.ljust(MAX_NAME_LENGTH)} {mix.guessed_name.ljust(MAX_NAME_LENGTH)} {str(mix.times).rjust(len('Count'))}\n"
+
+        await outbound.send(message.channel, content=content + "`")
+    elif message.content == STATS_COMMAND:
+        permissions = getattr(message.author, "guild_permissions", None)
+        if permissions is None or not permissions.administrator:
+            return
+        await outbound.send(message.channel, content=format_stats())
@@ -0,0 +1,138 @@
+from array import array
+import sys
+
+from messagequizzer.database import Message
+from messagequizzer.dedup import content_buckets
+
+# Rough per-entry costs on top of the message text, used for the memory cap.
+MESSAGE_OVERHEAD_BYTES = 16 + sys.getsizeof("")
+AUTHOR_OVERHEAD_BYTES = 100
+PAIR_OVERHEAD_BYTES = 120
+CHANNEL_OVERHEAD_BYTES = 100
+
+
+class GuildMessages:
+    # Columnar storage for one guild's pending messages: two int64 arrays and
+    # a list of contents instead of one dataclass instance per message.
+    __slots__ = ("message_ids", "author_ids", "contents")
+
+    def __init__(self):
+        self.message_ids = array("q")
+        self.author_ids = array("q")
+        self.contents: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.message_ids)
+
+    def append(self, message_id: int, author_id: int, content: str) -> None:
+        self.message_ids.append(message_id)
+        self.author_ids.append(author_id)
+        self.contents.append(content)
+
+    def extend_front(self, other: "GuildMessages") -> None:
+        self.message_ids[:0] = other.message_ids
+        self.author_ids[:0] = other.author_ids
+        self.contents[:0] = other.contents
+
+    def get(self, guild_id: int, index: int) -> Message:
+        return Message(
+            self.message_ids[index],
+            self.author_ids[index],
+            guild_id,
+            self.contents[index],
+        )
+
+    def rows(self, guild_id: int) -> list[tuple[int, int, int, str]]:
+        return [
+            (message_id, author_id, guild_id, content)
+            for message_id, author_id, content in zip(
+                self.message_ids, self.author_ids, self.contents
+            )
+        ]
+
+
+class PendingHistory:
+    # Everything read from Discord but not written yet: messages per guild,
+    # author names, channel checkpoints and guild/author pairs, with a running
+    # estimate of the memory it holds.
+    __slots__ = (
+        "guild_messages",
+        "authors",
+        "channels",
+        "guild_authors",
+        "message_count",
+        "estimated_bytes",
+    )
+
+    def __init__(self):
+        self.guild_messages: dict[int, GuildMessages] = {}
+        self.authors: dict[int, str] = {}
+        self.channels: dict[tuple[int, int], int] = {}  # by (guild_id, channel_id)
+        self.guild_authors: set[tuple[int, int]] = set()
+        self.message_count = 0
+        self.estimated_bytes = 0
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.guild_messages or self.authors or self.channels or self.guild_authors
+        )
+
+    def add_message(
+        self,
+        message_id: int,
+        author_id: int,
+        author_name: str,
+        guild_id: int,
+        content: str,
+    ) -> None:
+        messages = self.guild_messages.get(guild_id)
+        if messages is None:
+            messages = self.guild_messages[guild_id] = GuildMessages()
+        messages.append(message_id, author_id, content)
+        self.message_count += 1
+        self.estimated_bytes += MESSAGE_OVERHEAD_BYTES + len(content)
+        self.add_author(author_id, author_name)
+        pair = (guild_id, author_id)
+        if pair not in self.guild_authors:
+            self.guild_authors.add(pair)
+            self.estimated_bytes += PAIR_OVERHEAD_BYTES
+
+    def add_author(self, author_id: int, name: str) -> None:
+        if author_id not in self.authors:
+            self.estimated_bytes += AUTHOR_OVERHEAD_BYTES + len(name)
+        # Repeat authors share one name object across the buffer.
+        self.authors[author_id] = sys.intern(name)
+
+    def set_checkpoint(self, guild_id: int, channel_id: int, message_id: int) -> None:
+        key = (guild_id, channel_id)
+        if key not in self.channels:
+            self.estimated_bytes += CHANNEL_OVERHEAD_BYTES
+        self.channels[key] = message_id
+
+    def content_buckets(self) -> dict[int, list[list[int]]]:
+        # Duplicate detection buckets of every message, per guild and in row
+        # order; CPU heavy, so computed before the write transaction starts.
+        return {
+            guild_id: [content_buckets(content) for content in messages.contents]
+            for guild_id, messages in self.guild_messages.items()
+        }
+
+    def messages_of(self, guild_id: int) -> GuildMessages | None:
+        return self.guild_messages.get(guild_id)
+
+    def restore(self, older: "PendingHistory") -> None:
+        # Puts an older buffer that failed to flush back in front of this one;
+        # newer author names and checkpoints win.
+        for guild_id, messages in older.guild_messages.items():
+            current = self.guild_messages.get(guild_id)
+            if current is None:
+                current = self.guild_messages[guild_id] = GuildMessages()
+            current.extend_front(messages)
+        for author_id, name in older.authors.items():
+            if author_id not in self.authors:
+                self.authors[author_id] = name
+        for key, message_id in older.channels.items():
+            self.channels.setdefault(key, message_id)
+        self.guild_authors.update(older.guild_authors)
+        self.message_count += older.message_count
+        self.estimated_bytes += older.estimated_bytes
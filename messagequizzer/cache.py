@@ -0,0 +1,50 @@
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+import time
+
+
+class TTLCache:
+    # Results expire ttl seconds after they were loaded. Concurrent misses for
+    # the same key share one load instead of each running their own query.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries: dict[Hashable, tuple[float, Any]] = {}
+        self.loads: dict[Hashable, asyncio.Future] = {}
+        self.generation = 0
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        load = self.loads.get(key)
+        if load is None:
+            load = asyncio.ensure_future(self.load(key, loader))
+            self.loads[key] = load
+            load.add_done_callback(lambda _: self.loads.pop(key, None))
+        return await asyncio.shield(load)
+
+    async def load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        # A clear() while the loader runs means its result may predate the
+        # change that cleared the cache, so it is returned but not kept.
+        generation = self.generation
+        value = await loader()
+        if generation == self.generation:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.evict_expired()
+        return value
+
+    def evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self.entries.items() if expires <= now]
+        for key in expired:
+            del self.entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.entries.clear()
@@ -1,7 +1,61 @@
 NUMBER_OF_FALSE_ANSWERS = 2 # total of 3 answers
 MAX_NAME_LENGTH = 32 # characters
-DATABASE_UPDATE_COOLDOWN = 30  # secs
+DATABASE_UPDATE_COOLDOWN = 30  # secs, max age of a buffered message
+DATABASE_UPDATE_MAX_BUFFER_SIZE = 5000  # messages
+DATABASE_UPDATE_MAX_BUFFER_BYTES = 64 * 1024 * 1024  # estimated, caps catch-up memory
 GUESS_COMMAND = "!guess"
 SCOREBOARD_COMMAND = "!scores"
 PREDICTIBILITY_COMMAND = "!authors"
 MIXES_COMMAND = "!mixes"
+STATS_COMMAND = "!stats"  # administrators only
+CRAWL_MAX_CHANNELS = 8  # channels read at the same time
+CRAWL_MAX_CHANNELS_PER_GUILD = 3
+CRAWL_INITIAL_BACKOFF = 1  # secs
+CRAWL_MAX_BACKOFF = 60  # secs
+MAX_RATELIMIT_TIMEOUT = 30  # secs discord.py waits out a rate limit, 30 at least
+CRAWL_PROGRESS_INTERVAL = 30  # secs
+ROSTER_MAX_GUILDS = 1000  # guild author rosters kept in memory
+SAMPLER_MAX_GUILDS = 1000  # guild message id arrays kept in memory
+QUESTION_QUEUE_SIZE = 5  # prepared questions kept per guild
+QUESTION_QUEUE_MAX_GUILDS = 1000
+QUESTION_TIMEOUT = 180  # secs a question can be answered
+QUESTION_TIMER_TICK = 1  # secs, resolution of question timeouts
+QUESTION_CACHE_TTL = 60  # secs an answered question stays in memory
+DISTRACTOR_MIX_PRIOR = 10  # past mixes at which half of an author's distractors come from them
+DISTRACTOR_REBUILD_RATIO = 0.1  # guild growth that rebuilds its activity weights
+DISTRACTOR_MAX_DRAWS = 4  # weighted draws per distractor before filling uniformly
+KEYWORD_EXACT_SAMPLE_SIZE = 500  # matches of a !guess keyword sampled at once
+QUESTION_BUTTON_PREFIX = "mq:answer:"  # custom_id of answer buttons
+LEADERBOARD_SIZE = 10  # rows shown by !scores and !mixes
+LEADERBOARD_CACHE_TTL = 10  # secs
+LEADERBOARD_MAX_GUILDS = 1000  # guild score boards kept in memory
+GAME_EVENT_FLUSH_INTERVAL = 5  # secs between score and mix writes
+MESSAGE_MAX_LENGTH = 2000  # characters, Discord's limit
+OUTBOUND_CHANNEL_RATE = 5  # messages sent or edited per channel per period
+OUTBOUND_CHANNEL_PERIOD = 5  # secs
+OUTBOUND_GLOBAL_RATE = 40  # requests per sec, under Discord's global 50
+OUTBOUND_EDIT_RESERVE = 1  # requests question closing edits leave to replies
+OUTBOUND_MAX_RETRIES = 3  # per request answered with a 429
+OUTBOUND_STOP_TIMEOUT = 10  # secs queued messages get to go out on shutdown
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # Prometheus text endpoint at /metrics, None to disable
+SHARD_COUNT = None  # None lets Discord recommend one
+SHARD_PROCESSES = 1  # processes the shards are spread over
+WRITER_HOST = "127.0.0.1"  # writer service used when SHARD_PROCESSES > 1
+WRITER_PORT = 9120
+STORAGE_BACKEND = "file"  # "file", "sharded" for a file per guild, or "memory"
+STORAGE_DIRECTORY = "guilds"  # files of the sharded backend
+STORAGE_SHARDS = None  # files the sharded backend hashes guilds into, None for one each
+STORAGE_MAX_OPEN = 64  # guild files the sharded backend keeps open
+IMPORT_PROCESSES = 4  # worker processes parsing exports
+IMPORT_BATCH_SIZE = 50000  # messages per import transaction
+SHINGLE_SIZE = 3  # words per shingle for near-duplicate detection
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4  # signature rows per band
+RETENTION_MAX_MESSAGES_PER_GUILD = None  # e.g. 200000, None to keep every message
+RETENTION_MAX_MESSAGES_PER_AUTHOR = None  # per guild, e.g. 20000, None for no cap
+RETENTION_MAX_AGE_DAYS = None  # days, None to never age messages out
+RETENTION_INTERVAL = 3600  # secs between retention passes
+RETENTION_BATCH_SIZE = 1000  # rows deleted per transaction
+RETENTION_VACUUM_PAGES = 2000  # pages returned per incremental vacuum step
+RETENTION_FULL_VACUUM_FREE_RATIO = 0.25  # free pages that justify a full VACUUM
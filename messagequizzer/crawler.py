@@ -0,0 +1,248 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+import asyncio
+import random
+import time
+
+import discord
+
+from messagequizzer.config import *
+from messagequizzer.message_handler import read_history
+from messagequizzer.metrics import registry
+
+
+@dataclass
+class CrawlProgress:
+    channels_total: int = 0
+    channels_done: int = 0
+    channels_skipped: int = 0
+    messages_read: int = 0
+    rate_limits: int = 0
+    started_at: float = field(default_factory=time.time)
+
+    @property
+    def messages_per_second(self) -> float:
+        elapsed = time.time() - self.started_at
+        return self.messages_read / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        finished = self.channels_done + self.channels_skipped
+        return (
+            f"{finished}/{self.channels_total} channels, "
+            f"{self.messages_read} messages ({self.messages_per_second:.1f} msg/s), "
+            f"{self.rate_limits} rate limits"
+        )
+
+
+class AdaptiveLimiter:
+    # Concurrency limit that halves on every 429 and grows back by one slot
+    # after a run of channels that finished without being rate limited.
+    def __init__(self, limit: int, minimum: int = 1, recovery: int = 4):
+        self.maximum = limit
+        self.limit = limit
+        self.minimum = minimum
+        self.recovery = recovery
+        self.successes = 0
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def on_rate_limited(self):
+        self.successes = 0
+        self.limit = max(self.minimum, self.limit // 2)
+
+    async def on_success(self):
+        self.successes += 1
+        if self.successes >= self.recovery and self.limit < self.maximum:
+            self.successes = 0
+            async with self.condition:
+                self.limit += 1
+                self.condition.notify_all()
+
+
+class HistoryCrawler:
+    # Catch-up runs in background tasks, so commands are served from whatever
+    # is stored while it reads. A guild is ready once every one of its channels
+    # has been read up to its latest message, and can be cancelled on its own.
+    # Concurrent crawls share one limiter and one semaphore per guild, so the
+    # process never reads more than max_channels channels at once.
+    def __init__(
+        self,
+        max_channels: int = CRAWL_MAX_CHANNELS,
+        max_channels_per_guild: int = CRAWL_MAX_CHANNELS_PER_GUILD,
+        progress_interval: float = CRAWL_PROGRESS_INTERVAL,
+    ):
+        self.max_channels = max_channels
+        self.max_channels_per_guild = max_channels_per_guild
+        self.progress_interval = progress_interval
+        self.limiter = AdaptiveLimiter(max_channels)
+        self.guild_limits: defaultdict[int, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self.max_channels_per_guild)
+        )
+        self.channels_left: dict[int, int] = {}
+        self.ready_guilds: set[int] = set()
+        self.channel_tasks: defaultdict[int, set[asyncio.Task]] = defaultdict(set)
+        self.tasks: set[asyncio.Task] = set()
+
+    def is_ready(self, guild_id: int) -> bool:
+        return guild_id in self.ready_guilds
+
+    def is_catching_up(self, guild_id: int) -> bool:
+        return guild_id in self.channels_left
+
+    def start(self, guilds: list[discord.Guild]) -> asyncio.Task:
+        task = asyncio.create_task(self.crawl(guilds))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel_guild(self, guild_id: int) -> None:
+        # Queued channels of the guild are skipped and the ones being read are
+        # cancelled; their checkpoints keep what was read so far.
+        self.channels_left.pop(guild_id, None)
+        self.ready_guilds.discard(guild_id)
+        self.guild_limits.pop(guild_id, None)
+        for task in self.channel_tasks.pop(guild_id, ()):
+            task.cancel()
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def finish_channel(self, guild: discord.Guild) -> None:
+        if guild.id not in self.channels_left:
+            return
+        self.channels_left[guild.id] -= 1
+        if self.channels_left[guild.id] <= 0:
+            del self.channels_left[guild.id]
+            self.guild_limits.pop(guild.id, None)
+            self.ready_guilds.add(guild.id)
+            print(f"Caught up with {guild.name}!")
+
+    @staticmethod
+    def channel_priority(channel: discord.TextChannel) -> int:
+        # Snowflakes grow with time, so the latest message id orders channels
+        # by recent activity; channels that never had a message go last.
+        return -(channel.last_message_id or 0)
+
+    async def crawl(self, guilds: list[discord.Guild]) -> CrawlProgress:
+        # Guilds that are still being crawled, like those of a shard that
+        # reconnected, are left to the crawl that is reading them.
+        guilds = [guild for guild in guilds if guild.id not in self.channels_left]
+        channels = sorted(
+            (channel for guild in guilds for channel in guild.text_channels),
+            key=self.channel_priority,
+        )
+        progress = CrawlProgress(channels_total=len(channels))
+        for guild in guilds:
+            self.ready_guilds.discard(guild.id)
+            self.channels_left[guild.id] = len(guild.text_channels)
+            if not guild.text_channels:
+                self.finish_channel(guild)
+        if not channels:
+            return progress
+
+        pending = asyncio.Queue()
+        for channel in channels:
+            pending.put_nowait(channel)
+
+        reporter = asyncio.create_task(self.report_progress(progress))
+        workers = [
+            asyncio.create_task(self.work(pending, progress))
+            for _ in range(min(self.max_channels, len(channels)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+        print(f"Caught up: {progress}")
+        return progress
+
+    async def work(self, pending: asyncio.Queue, progress: CrawlProgress):
+        while not pending.empty():
+            channel = pending.get_nowait()
+            guild = channel.guild
+            if guild.id not in self.channels_left:
+                progress.channels_skipped += 1
+                continue
+            async with self.guild_limits[guild.id]:
+                task = asyncio.create_task(self.crawl_channel(channel, progress))
+                self.channel_tasks[guild.id].add(task)
+                try:
+                    await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    if not task.cancelled():
+                        # The worker itself was cancelled, not just the guild.
+                        task.cancel()
+                        raise
+                    progress.channels_skipped += 1
+                    continue
+                finally:
+                    self.channel_tasks[guild.id].discard(task)
+                    if not self.channel_tasks[guild.id]:
+                        self.channel_tasks.pop(guild.id, None)
+            self.finish_channel(guild)
+
+    async def crawl_channel(
+        self, channel: discord.TextChannel, progress: CrawlProgress
+    ):
+        backoff = CRAWL_INITIAL_BACKOFF
+        while True:
+            try:
+                async with self.limiter:
+                    print(f"Checking #{channel.name} of {channel.guild.name}")
+                    read_count = await read_history(channel)
+                progress.messages_read += read_count
+            except discord.Forbidden:
+                progress.channels_skipped += 1
+                return
+            except (discord.RateLimited, discord.HTTPException) as exception:
+                # discord.py waits out short rate limits itself; it raises
+                # RateLimited for longer ones, and a 429 once it gave up.
+                if isinstance(exception, discord.HTTPException):
+                    if exception.status != 429:
+                        print(
+                            f"Skipping #{channel.name} of {channel.guild.name}: {exception}"
+                        )
+                        progress.channels_skipped += 1
+                        return
+                    retry_after = backoff
+                else:
+                    retry_after = exception.retry_after
+                # read_history resumes from the channel checkpoint, so retrying
+                # only fetches what was not read before the rate limit.
+                progress.rate_limits += 1
+                self.limiter.on_rate_limited()
+                await asyncio.sleep(retry_after + random.uniform(0, backoff))
+                backoff = min(backoff * 2, CRAWL_MAX_BACKOFF)
+                continue
+            await self.limiter.on_success()
+            progress.channels_done += 1
+            return
+
+    async def report_progress(self, progress: CrawlProgress):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            print(f"Catching up: {progress}")
+
+
+crawler = HistoryCrawler()
+
+registry.gauge(
+    "messagequizzer_guilds_catching_up",
+    "Guilds with channels whose history is still being read.",
+    lambda: len(crawler.channels_left),
+)
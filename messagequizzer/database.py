@@ -1,7 +1,18 @@
+from array import array
+import asyncio
+import json
+import random
 import sqlite3
-import datetime
 from dataclasses import dataclass
 
+from messagequizzer.backends import StorageBackend, create_backend
+from messagequizzer.config import *
+from messagequizzer.dedup import content_buckets
+from messagequizzer.metrics import DUPLICATES, instrument_dao
+from messagequizzer.sampler import MessageSampler
+
+SQLITE_MAX_PARAMETERS = 900
+
 
 @dataclass
 class Message:
@@ -18,23 +29,37 @@ class Author:
 
 
 @dataclass
-class Player:
+class MixedAuthor:
+    correct_id: int
+    guessed_id: int
+    times: int
+
+
+@dataclass
+class ScoreboardEntry:
     player_id: int
+    name: str
     score: int
     total_tries: int
 
+    @property
+    def average_guess(self) -> float:
+        return self.total_tries / self.score
+
 
 @dataclass
-class MixedAuthor:
+class MixEntry:
     correct_id: int
+    correct_name: str
     guessed_id: int
+    guessed_name: str
     times: int
 
 
 @dataclass
 class TextChannel:
     channel_id: int
-    last_read: datetime.datetime
+    last_message_id: int
 
 
 @dataclass
@@ -43,418 +68,738 @@ class GuildAuthor:
     author_id: int
 
 
-class MessageDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
+@dataclass
+class OpenQuestion:
+    message_id: int  # of the posted question
+    channel_id: int
+    guild_id: int
+    correct_id: int
+    content: str
+    choices: list[Author]
+    expires_at: float
 
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id INTEGER PRIMARY KEY,
-                author_id INTEGER,
-                guild_id INTEGER,
-                content TEXT
-            )
-        """
+    @property
+    def correct_author(self) -> Author:
+        return next(
+            author for author in self.choices if author.author_id == self.correct_id
         )
-        self.conn.commit()
 
-    def insert_message(self, message: Message):
-        self.cursor.execute(
-            "INSERT INTO messages (message_id, author_id, guild_id, content) VALUES (?, ?, ?, ?)",
-            (message.message_id, message.author_id, message.guild_id, message.content),
-        )
-        self.conn.commit()
+
+@instrument_dao
+class MessageDAO:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.sampler = MessageSampler()
+        self.index_loads: dict[int, asyncio.Future] = {}
+
+    async def insert_message(self, message: Message):
+        await self.insert_messages([message])
 
     async def insert_messages(self, messages: list[Message]):
-        values = [
+        rows = [
             (message.message_id, message.author_id, message.guild_id, message.content)
             for message in messages
         ]
-        self.cursor.executemany(
-            "INSERT OR REPLACE INTO messages (message_id, author_id, guild_id, content) VALUES (?, ?, ?, ?)",
-            values,
+        # Each guild's rows are committed on their own, outside any transaction.
+        for guild_id, guild_rows in group_by_guild(rows, 2).items():
+            new_message_ids = await self.insert_message_rows(guild_id, guild_rows)
+            self.add_to_index(guild_id, new_message_ids)
+
+    async def insert_message_rows(
+        self, guild_id: int, rows: list[tuple[int, int, int, str]]
+    ) -> list[int]:
+        # Rows are (message_id, author_id, guild_id, content) tuples of one guild.
+        # Returns the ids that were not stored before, for add_to_index once
+        # they are committed; a rolled back transaction must not leave them in
+        # the sampler.
+        rows = list({row[0]: row for row in rows}.values())
+        new_message_ids = await self.backend.guild(guild_id).write(
+            self._insert_message_rows, rows
         )
-        self.conn.commit()
-
-    def get_random_message_by_guild_id(self, guild_id: int) -> Message:
-        self.cursor.execute(
-            """
-            SELECT * FROM messages
-            WHERE guild_id = ?
-            ORDER BY RANDOM()
-            LIMIT 1
-        """,
-            (guild_id,),
+        return [row[0] for row in rows if row[0] in new_message_ids]
+
+    def add_to_index(self, guild_id: int, message_ids: list[int]) -> None:
+        self.sampler.add_messages(guild_id, message_ids)
+
+    @staticmethod
+    def _insert_message_rows(
+        cursor: sqlite3.Cursor, rows: list[tuple[int, int, int, str]]
+    ) -> set[int]:
+        # Rows stored before are looked up first: the search index needs their
+        # old text to drop them, and the sampler only takes the new ids.
+        message_ids = [row[0] for row in rows]
+        stored_rows = []
+        for start in range(0, len(message_ids), SQLITE_MAX_PARAMETERS):
+            chunk = message_ids[start : start + SQLITE_MAX_PARAMETERS]
+            cursor.execute(
+                f"SELECT message_id, content, guild_id FROM messages WHERE message_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            stored_rows.extend(cursor.fetchall())
+        cursor.executemany(
+            "INSERT INTO message_search (message_search, rowid, content, guild_id) VALUES ('delete', ?, ?, ?)",
+            stored_rows,
+        )
+        cursor.executemany(
+            "INSERT OR REPLACE INTO messages (message_id, author_id, guild_id, content, sample_key) VALUES (?, ?, ?, ?, random())",
+            rows,
+        )
+        cursor.executemany(
+            "INSERT INTO message_search (rowid, content, guild_id) VALUES (?, ?, ?)",
+            [(message_id, content, guild_id) for message_id, _, guild_id, content in rows],
+        )
+        return set(message_ids).difference(row[0] for row in stored_rows)
+
+    async def load_guild_index(self, guild_id: int):
+        if self.sampler.is_loaded(guild_id):
+            return
+        load = self.index_loads.get(guild_id)
+        if load is None:
+            load = asyncio.ensure_future(self._load_guild_index(guild_id))
+            self.index_loads[guild_id] = load
+            load.add_done_callback(lambda _: self.index_loads.pop(guild_id, None))
+        await asyncio.shield(load)
+
+    async def _load_guild_index(self, guild_id: int):
+        self.sampler.begin_load(guild_id)
+        try:
+            # Built in the reader thread, since a large guild's ids take a while.
+            message_ids = await self.backend.guild(guild_id).read(
+                lambda cursor: array(
+                    "q",
+                    (
+                        row[0]
+                        for row in cursor.execute(
+                            "SELECT message_id FROM messages WHERE guild_id = ?",
+                            (guild_id,),
+                        )
+                    ),
+                )
+            )
+        except BaseException:
+            self.sampler.cancel_load(guild_id)
+            raise
+        self.sampler.finish_load(guild_id, message_ids)
+
+    async def get_message_count_by_guild_id(self, guild_id: int) -> int:
+        await self.load_guild_index(guild_id)
+        return self.sampler.count(guild_id)
+
+    async def get_message_by_id(self, guild_id: int, message_id: int) -> Message:
+        row = await self.backend.guild(guild_id).fetchone(
+            "SELECT * FROM messages WHERE message_id = ?",
+            (message_id,),
         )
-        row = self.cursor.fetchone()
         if row:
             message = Message(row[0], row[1], row[2], row[3])
             return message
         return None
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
+    async def get_message_by_guild_index(self, guild_id: int, index: int) -> Message:
+        await self.load_guild_index(guild_id)
+        return await self.get_message_by_id(
+            guild_id, self.sampler.get_message_id(guild_id, index)
+        )
 
+    async def get_random_message_by_guild_id(self, guild_id: int) -> Message:
+        await self.load_guild_index(guild_id)
+        message_id = self.sampler.choose_message_id(guild_id)
+        if message_id is None:
+            return None
+        return await self.get_message_by_id(guild_id, message_id)
+
+    async def get_random_message_by_keyword(
+        self, guild_id: int, keyword: str
+    ) -> Message | None:
+        # Keywords with few matches are sampled exactly. Counting the matches of
+        # a common keyword takes as long as reading them all, so those start
+        # from a uniformly random stored message instead and pick one of the
+        # next matches, wrapping around. Matches after a long gap are still
+        # favoured, but only as much as the gap is longer than the ones around
+        # it, so a single old mention does not win over a busy thread.
+        await self.load_guild_index(guild_id)
+        phrase = keyword.replace('"', '""')
+        query = f'guild_id : "{guild_id}" AND content : "{phrase}"'
+        message_id = await self.backend.guild(guild_id).read(
+            self._find_keyword_message_id,
+            query,
+            self.sampler.choose_message_id(guild_id),
+        )
+        if message_id is None:
+            return None
+        return await self.get_message_by_id(guild_id, message_id)
+
+    @staticmethod
+    def _find_keyword_message_id(
+        cursor: sqlite3.Cursor, query: str, pivot_id: int | None
+    ) -> int | None:
+        message_ids = cursor.execute(
+            "SELECT rowid FROM message_search WHERE message_search MATCH ? ORDER BY rowid LIMIT ?",
+            (query, KEYWORD_EXACT_SAMPLE_SIZE + 1),
+        ).fetchall()
+        if len(message_ids) <= KEYWORD_EXACT_SAMPLE_SIZE or pivot_id is None:
+            return random.choice(message_ids)[0] if message_ids else None
+        window = cursor.execute(
+            "SELECT rowid FROM message_search WHERE message_search MATCH ? AND rowid >= ? ORDER BY rowid LIMIT ?",
+            (query, pivot_id, KEYWORD_EXACT_SAMPLE_SIZE),
+        ).fetchall()
+        # There are more matches than the window holds, so the first ones of
+        # all are before the pivot.
+        window += message_ids[: KEYWORD_EXACT_SAMPLE_SIZE - len(window)]
+        return random.choice(window)[0]
+
+    async def get_author_message_counts(self, guild_id: int) -> dict[int, int]:
+        rows = await self.backend.guild(guild_id).fetchall(
+            "SELECT author_id, count(*) FROM messages WHERE guild_id = ? GROUP BY author_id",
+            (guild_id,),
+        )
+        return dict(rows)
+
+    # Retention candidates are (message_id, content) rows, so the caller can
+    # work out their duplicate buckets before deleting them.
+    async def get_messages_before(
+        self, guild_id: int, message_id: int, limit: int
+    ) -> list[tuple[int, str]]:
+        return await self.backend.guild(guild_id).fetchall(
+            "SELECT message_id, content FROM messages WHERE guild_id = ? AND message_id < ? LIMIT ?",
+            (guild_id, message_id, limit),
+        )
 
-class AuthorDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
+    async def get_excess_guild_messages(
+        self, guild_id: int, max_messages: int, limit: int
+    ) -> list[tuple[int, str]]:
+        return await self.backend.guild(guild_id).fetchall(
+            "SELECT message_id, content FROM messages WHERE guild_id = ? ORDER BY sample_key LIMIT ? OFFSET ?",
+            (guild_id, limit, max_messages),
+        )
 
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS authors (
-                author_id INTEGER PRIMARY KEY,
-                display_name TEXT
+    async def get_excess_author_messages(
+        self, guild_id: int, max_messages: int, limit: int
+    ) -> list[tuple[int, str]]:
+        storage = self.backend.guild(guild_id)
+        rows = []
+        authors = await storage.fetchall(
+            "SELECT author_id FROM messages WHERE guild_id = ? GROUP BY author_id HAVING count(*) > ?",
+            (guild_id, max_messages),
+        )
+        for (author_id,) in authors:
+            if len(rows) >= limit:
+                break
+            rows.extend(
+                await storage.fetchall(
+                    "SELECT message_id, content FROM messages WHERE guild_id = ? AND author_id = ? ORDER BY sample_key LIMIT ? OFFSET ?",
+                    (guild_id, author_id, limit - len(rows), max_messages),
+                )
             )
-        """
+        return rows
+
+    async def delete_messages(self, guild_id: int, message_ids: list[int]):
+        await self.backend.guild(guild_id).write(self._delete_messages, message_ids)
+        self.sampler.remove_messages(guild_id, message_ids)
+
+    @staticmethod
+    def _delete_messages(cursor: sqlite3.Cursor, message_ids: list[int]):
+        params = [(message_id,) for message_id in message_ids]
+        cursor.executemany(
+            "INSERT INTO message_search (message_search, rowid, content, guild_id) SELECT 'delete', message_id, content, guild_id FROM messages WHERE message_id = ?",
+            params,
         )
-        self.conn.commit()
+        cursor.executemany("DELETE FROM messages WHERE message_id = ?", params)
+
+
+@instrument_dao
+class MessageBucketDAO:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+
+    async def claim_unique_rows(
+        self,
+        guild_id: int,
+        rows: list[tuple[int, int, int, str]],
+        row_buckets: list[list[int]] | None = None,
+    ) -> list[tuple[int, int, int, str]]:
+        # Returns the rows whose content is new to their guild, and records
+        # their buckets so later copies of it are dropped as well.
+        if row_buckets is None:
+            row_buckets = [content_buckets(row[3]) for row in rows]
+        unique_rows = await self.backend.guild(guild_id).write(
+            self._claim_unique_rows, rows, row_buckets
+        )
+        DUPLICATES.inc(len(rows) - len(unique_rows))
+        return unique_rows
+
+    @staticmethod
+    def _claim_unique_rows(
+        cursor: sqlite3.Cursor,
+        rows: list[tuple[int, int, int, str]],
+        row_buckets: list[list[int]],
+    ) -> list[tuple[int, int, int, str]]:
+        buckets_by_guild: dict[int, set[int]] = {}
+        for row, buckets in zip(rows, row_buckets):
+            buckets_by_guild.setdefault(row[2], set()).update(buckets)
+        seen = set()
+        for guild_id, buckets in buckets_by_guild.items():
+            buckets = list(buckets)
+            for start in range(0, len(buckets), SQLITE_MAX_PARAMETERS):
+                chunk = buckets[start : start + SQLITE_MAX_PARAMETERS]
+                cursor.execute(
+                    f"SELECT bucket FROM MessageBuckets WHERE guild_id = ? AND bucket IN ({', '.join('?' * len(chunk))})",
+                    [guild_id, *chunk],
+                )
+                seen.update((guild_id, row[0]) for row in cursor.fetchall())
+
+        unique_rows = []
+        new_buckets = []
+        for row, buckets in zip(rows, row_buckets):
+            keys = [(row[2], bucket) for bucket in buckets]
+            if any(key in seen for key in keys):
+                continue
+            seen.update(keys)
+            new_buckets.extend(keys)
+            unique_rows.append(row)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO MessageBuckets (guild_id, bucket) VALUES (?, ?)",
+            new_buckets,
+        )
+        return unique_rows
+
+    async def release_buckets(self, guild_id: int, buckets: list[int]):
+        # Content of deleted messages may be stored again later.
+        await self.backend.guild(guild_id).executemany(
+            "DELETE FROM MessageBuckets WHERE guild_id = ? AND bucket = ?",
+            [(guild_id, bucket) for bucket in buckets],
+        )
+
+
+@instrument_dao
+class AuthorDAO:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
 
-    def insert_author(self, author: Author):
-        self.cursor.execute(
+    async def insert_author(self, author: Author):
+        await self.backend.shared.execute(
             "INSERT OR REPLACE INTO authors (author_id, display_name) VALUES (?, ?)",
             (author.author_id, author.name),
         )
-        self.conn.commit()
 
     async def insert_authors(self, authors: dict[int, str]):
         values = [(id, name) for id, name in authors.items()]
-        self.cursor.executemany(
+        await self.backend.shared.executemany(
             "INSERT OR REPLACE INTO authors (author_id, display_name) VALUES (?, ?)",
             values,
         )
-        self.conn.commit()
 
-    def get_author_by_id(self, author_id) -> Author:
-        self.cursor.execute(
+    async def get_author_by_id(self, author_id) -> Author:
+        row = await self.backend.shared.fetchone(
             """
             SELECT * FROM authors
             WHERE author_id = ?
         """,
             (author_id,),
         )
-        row = self.cursor.fetchone()
         if row:
             author = Author(row[0], row[1])
             return author
         return None
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
-
 
+@instrument_dao
 class TextChannelDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS channels (
-                channel_id INTEGER PRIMARY KEY,
-                last_read TEXT
-            )
-        """
-        )
-        self.conn.commit()
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
 
-    def insert_channel(self, channel: TextChannel):
-        self.cursor.execute(
-            "INSERT INTO channels (channel_id, last_read) VALUES (?, ?)",
-            (channel.channel_id, channel.last_read),
+    async def insert_channel(self, guild_id: int, channel: TextChannel):
+        await self.insert_channels(
+            guild_id, {channel.channel_id: channel.last_message_id}
         )
-        self.conn.commit()
 
-    async def insert_channels(self, channels: dict[int, datetime.datetime]):
-        values = [
-            (channel_id, last_read.strftime("%Y-%m-%d %H:%M:%S"))
-            for channel_id, last_read in channels.items()
-        ]
-        self.cursor.executemany(
-            "INSERT OR REPLACE INTO channels (channel_id, last_read) VALUES (?, ?)",
-            values,
+    async def insert_channels(self, guild_id: int, channels: dict[int, int]):
+        # Checkpoints only move forward, whatever order the flushes land in.
+        await self.backend.guild(guild_id).executemany(
+            """
+            INSERT INTO channels (channel_id, last_message_id) VALUES (?, ?)
+            ON CONFLICT (channel_id) DO UPDATE
+            SET last_message_id = max(
+                coalesce(last_message_id, 0), excluded.last_message_id
+            )
+            """,
+            list(channels.items()),
         )
-        self.conn.commit()
 
-    def get_channel_by_id(self, channel_id: int) -> TextChannel:
-        self.cursor.execute(
+    async def get_channel_by_id(self, guild_id: int, channel_id: int) -> TextChannel:
+        row = await self.backend.guild(guild_id).fetchone(
             """
-            SELECT * FROM channels
+            SELECT channel_id, last_message_id FROM channels
             WHERE channel_id = ?
         """,
             (channel_id,),
         )
-        row = self.cursor.fetchone()
-        if row:
-            channel = TextChannel(
-                row[0], datetime.datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S")
-            )
+        if row and row[1] is not None:
+            channel = TextChannel(row[0], row[1])
             return channel
         return None
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
-
 
+@instrument_dao
 class GuildAuthorDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS GuildAuthors (
-                guild_id INTEGER,
-                author_id INTEGER,
-                PRIMARY KEY (guild_id, author_id)
-            )
-        """
-        )
-        self.conn.commit()
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
 
-    def insert_author_to_guild(self, author_id: int, guild_id: int):
+    async def insert_author_to_guild(self, author_id: int, guild_id: int):
         query = "INSERT INTO GuildAuthors (author_id, guild_id) VALUES (?, ?)"
-        self.cursor.execute(query, (author_id, guild_id))
-        self.conn.commit()
+        await self.backend.guild(guild_id).execute(query, (author_id, guild_id))
 
     async def insert_authors_to_guilds(self, pairs: list[GuildAuthor]):
         query = (
             "INSERT OR REPLACE INTO GuildAuthors (author_id, guild_id) VALUES (?, ?)"
         )
-        self.cursor.executemany(
-            query, [(pair.author_id, pair.guild_id) for pair in pairs]
-        )
-        self.conn.commit()
-
-    def get_authors_by_guild(self, guild_id: int) -> list[Author]:
+        rows = [(pair.author_id, pair.guild_id) for pair in pairs]
+        for guild_id, guild_rows in group_by_guild(rows, 1).items():
+            await self.backend.guild(guild_id).executemany(query, guild_rows)
+
+    async def get_guild_ids(self) -> list[int]:
+        guild_ids = set()
+        for storage in self.backend.guild_storages():
+            rows = await storage.fetchall("SELECT DISTINCT guild_id FROM GuildAuthors")
+            guild_ids.update(row[0] for row in rows)
+        return sorted(guild_ids)
+
+    async def get_author_ids_by_guild(self, guild_id: int) -> list[int]:
+        return await get_guild_author_ids(self.backend, guild_id)
+
+    async def get_authors_by_guild(self, guild_id: int) -> list[Author]:
+        author_ids = await self.get_author_ids_by_guild(guild_id)
         query = """
             SELECT authors.*
-            FROM authors
-            INNER JOIN GuildAuthors ON authors.author_id = GuildAuthors.author_id
-            WHERE GuildAuthors.guild_id = ?
+            FROM json_each(?) AS guild_authors
+            INNER JOIN authors ON authors.author_id = guild_authors.value
         """
-        self.cursor.execute(query, (guild_id,))
-        rows = self.cursor.fetchall()
+        rows = await self.backend.shared.fetchall(query, (json.dumps(author_ids),))
         authors = []
         for row in rows:
             author = Author(row[0], row[1])
             authors.append(author)
         return authors
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
-
 
-class PlayerDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS players (
-                player_id INTEGER PRIMARY KEY,
-                score INTEGER,
-                total_tries INTEGER
-            )
-        """
-        )
-        self.conn.commit()
+@instrument_dao
+class GuildPlayerDAO:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
 
-    def get_all_players_by_guild_ascending_by_avg_guess_by_score(
+    async def get_scoreboard_by_guild(
         self,
         guild_id: int,
         limit: int,
-    ) -> list[Player]:
-        self.cursor.execute(
+    ) -> list[ScoreboardEntry]:
+        rows = await self.backend.guild(guild_id).fetchall(
             """
-            SELECT *
-            FROM players p
-            INNER JOIN GuildAuthors ga ON p.player_id = ga.author_id
-            WHERE ga.guild_id = ?
-            ORDER BY p.total_tries/p.score ASC
+            SELECT player_id, name, score, total_tries
+            FROM GuildPlayers
+            WHERE guild_id = ? AND score > 0
+            ORDER BY average_guess ASC, player_id ASC
             LIMIT ?
             """,
             (guild_id, limit),
         )
-        rows = self.cursor.fetchall()
-        players = []
-        for row in rows:
-            player = Player(row[0], row[1], row[2])
-            players.append(player)
-        return players
-
-    def check_player_exists(self, player_id: int) -> bool:
-        return self.get_player_by_id(player_id) != None
-
-    def insert_player(self, player: Player):
-        self.cursor.execute(
-            "INSERT OR REPLACE INTO players (player_id, score, total_tries) VALUES (?, ?, ?)",
-            (player.player_id, 1, 1),
+        return [ScoreboardEntry(row[0], row[1], row[2], row[3]) for row in rows]
+
+    async def get_scoreboard_entry(
+        self, guild_id: int, player_id: int
+    ) -> ScoreboardEntry | None:
+        row = await self.backend.guild(guild_id).fetchone(
+            "SELECT player_id, name, score, total_tries FROM GuildPlayers WHERE guild_id = ? AND player_id = ?",
+            (guild_id, player_id),
         )
-        self.conn.commit()
-
-    async def insert_players(self, player_ids: list[int]):
-        values = [(id, 1, 1) for id in player_ids]
-        self.cursor.executemany(
-            "INSERT OR REPLACE INTO players (player_id, score, total_tries) VALUES (?, ?, ?)",
-            values,
-        )
-        self.conn.commit()
-
-    def get_player_by_id(self, player_id: int) -> Player:
-        self.cursor.execute(
-            """
-            SELECT * FROM players
-            WHERE player_id = ?
-        """,
-            (player_id,),
-        )
-        row = self.cursor.fetchone()
         if row:
-            player = Player(row[0], row[1], row[2])
-            return player
+            return ScoreboardEntry(row[0], row[1], row[2], row[3])
         return None
 
-    async def update_player(self, player_id: int, try_count: int):
-        if self.check_player_exists(player_id):
-            self.cursor.execute(
+    async def update_players(self, player_deltas: list[tuple[int, int, str, int, int]]):
+        # Each entry is (guild_id, player_id, name, score increase,
+        # total_tries increase).
+        for guild_id, guild_deltas in group_by_guild(player_deltas, 0).items():
+            await self.backend.guild(guild_id).executemany(
                 """
-                UPDATE players 
-                SET score = score + 1,
-                    total_tries = total_tries + ?
-                WHERE player_id = ?""",
-                (try_count, player_id),
+                INSERT INTO GuildPlayers (guild_id, player_id, name, score, total_tries)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, player_id) DO UPDATE
+                SET name = excluded.name,
+                    score = score + excluded.score,
+                    total_tries = total_tries + excluded.total_tries
+                """,
+                guild_deltas,
             )
-            self.conn.commit()
-        else:
-            self.insert_player(Player(player_id, 1, try_count))
-
-    async def update_players(self, player_try_pairs: list[tuple[int, int]]):
-        values = [(try_count, player_id) for player_id, try_count in player_try_pairs]
-        self.cursor.executemany(
-            """
-            UPDATE players 
-            SET score = score + 1,
-                total_tries = total_tries + ?
-            WHERE player_id = ?""",
-            values,
-        )
-        self.conn.commit()
-
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
 
 
+@instrument_dao
 class MixedAuthorDAO:
-    def __init__(self, db_name: str):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-
-    def create_table(self):
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS MixedAuthors (
-                correct_id INTEGER,
-                guessed_id INTEGER,
-                times INTEGER,
-                PRIMARY KEY (correct_id, guessed_id)
-            )
-        """
-        )
-        self.conn.commit()
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
 
-    def get_mix_by_ids(self, correct_id: int, guessed_id: int) -> MixedAuthor:
+    async def get_mix_by_ids(self, correct_id: int, guessed_id: int) -> MixedAuthor:
         query = "SELECT * FROM MixedAuthors WHERE correct_id = ? AND guessed_id = ?"
-        self.cursor.execute(query, (correct_id, guessed_id))
-        row = self.cursor.fetchone()
+        row = await self.backend.shared.fetchone(query, (correct_id, guessed_id))
         if row:
             return MixedAuthor(row[0], row[1], row[2])
         return None
 
     async def increase_mix(self, correct_id: int, guessed_id: int, increase: int = 1):
-        if self.get_mix_by_ids(correct_id, guessed_id):
-            query = """
-                UPDATE MixedAuthors 
-                SET times = times + ?
-                WHERE correct_id = ? AND guessed_id = ?
+        await self.backend.shared.write(
+            self._increase_mix, correct_id, guessed_id, increase
+        )
+
+    @staticmethod
+    def _increase_mix(
+        cursor: sqlite3.Cursor, correct_id: int, guessed_id: int, increase: int
+    ):
+        cursor.execute(
             """
-            self.cursor.execute(query, (increase, correct_id, guessed_id))
-            self.conn.commit()
-        else:
-            await self.insert_mix(correct_id, guessed_id, increase)
+            UPDATE MixedAuthors 
+            SET times = times + ?
+            WHERE correct_id = ? AND guessed_id = ?
+        """,
+            (increase, correct_id, guessed_id),
+        )
+        if cursor.rowcount == 0:
+            cursor.execute(
+                "INSERT INTO MixedAuthors (correct_id, guessed_id, times) VALUES (?, ?, ?)",
+                (correct_id, guessed_id, increase),
+            )
+
+    # Mix queries write +guessed_id so only correct_id probes the index;
+    # otherwise every pair of the guild's authors would be looked up.
+    async def get_mixes_by_guild(self, guild_id: int) -> list[MixedAuthor]:
+        author_ids = await get_guild_author_ids(self.backend, guild_id)
+        rows = await self.backend.shared.fetchall(
+            """
+            WITH guild_authors (author_id) AS (SELECT value FROM json_each(?))
+            SELECT p.*
+            FROM MixedAuthors p
+            WHERE p.correct_id IN guild_authors AND +p.guessed_id IN guild_authors
+            """,
+            (json.dumps(author_ids),),
+        )
+        return [MixedAuthor(row[0], row[1], row[2]) for row in rows]
 
-    def get_all_mixes_by_guild_descending_by_times(
+    async def get_all_mixes_by_guild_descending_by_times(
         self,
         guild_id: int,
         limit: int,
     ) -> list[MixedAuthor]:
-        self.cursor.execute(
+        author_ids = await get_guild_author_ids(self.backend, guild_id)
+        rows = await self.backend.shared.fetchall(
             """
-            SELECT *
+            WITH guild_authors (author_id) AS (SELECT value FROM json_each(?))
+            SELECT p.*
             FROM MixedAuthors p
-            WHERE p.correct_id IN (
-                SELECT author_id
-                FROM GuildAuthors
-                WHERE guild_id = ?
-            ) AND p.guessed_id IN (
-                SELECT author_id
-                FROM GuildAuthors
-                WHERE guild_id = ?
-            )
+            WHERE p.correct_id IN guild_authors AND +p.guessed_id IN guild_authors
             ORDER BY p.times DESC
             LIMIT ?
             """,
-            (guild_id, guild_id, limit),
+            (json.dumps(author_ids), limit),
         )
-        rows = self.cursor.fetchall()
         mixes = []
         for row in rows:
             player = MixedAuthor(row[0], row[1], row[2])
             mixes.append(player)
         return mixes
 
+    async def increase_mixes(self, mix_deltas: list[tuple[int, int, int]]):
+        # Each entry is (correct_id, guessed_id, times increase).
+        await self.backend.shared.executemany(
+            """
+            INSERT INTO MixedAuthors (correct_id, guessed_id, times) VALUES (?, ?, ?)
+            ON CONFLICT (correct_id, guessed_id) DO UPDATE
+            SET times = times + excluded.times
+            """,
+            mix_deltas,
+        )
+
+    async def get_mix_board_by_guild(
+        self,
+        guild_id: int,
+        limit: int,
+    ) -> list[MixEntry]:
+        author_ids = await get_guild_author_ids(self.backend, guild_id)
+        rows = await self.backend.shared.fetchall(
+            """
+            WITH guild_authors (author_id) AS (SELECT value FROM json_each(?))
+            SELECT m.correct_id, ca.display_name, m.guessed_id, ga.display_name, m.times
+            FROM MixedAuthors m
+            INNER JOIN authors ca ON ca.author_id = m.correct_id
+            INNER JOIN authors ga ON ga.author_id = m.guessed_id
+            WHERE m.correct_id IN guild_authors AND +m.guessed_id IN guild_authors
+            ORDER BY m.times DESC
+            LIMIT ?
+            """,
+            (json.dumps(author_ids), limit),
+        )
+        return [MixEntry(row[0], row[1], row[2], row[3], row[4]) for row in rows]
+
+    async def get_mix_entries_by_ids(
+        self,
+        guild_id: int,
+        pairs: list[tuple[int, int]],
+    ) -> list[MixEntry]:
+        # Mixes of the guild among pairs, with zero times if they have no row
+        # yet, for merging unflushed mix deltas into the board.
+        author_ids = set(await get_guild_author_ids(self.backend, guild_id))
+        pairs = [pair for pair in pairs if author_ids.issuperset(pair)]
+        entries = []
+        chunk_size = SQLITE_MAX_PARAMETERS // 2
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start : start + chunk_size]
+            rows = await self.backend.shared.fetchall(
+                f"""
+                WITH pending (correct_id, guessed_id) AS (
+                    VALUES {', '.join(['(?, ?)'] * len(chunk))}
+                )
+                SELECT pending.correct_id, ca.display_name,
+                    pending.guessed_id, ga.display_name, coalesce(m.times, 0)
+                FROM pending
+                INNER JOIN authors ca ON ca.author_id = pending.correct_id
+                INNER JOIN authors ga ON ga.author_id = pending.guessed_id
+                LEFT JOIN MixedAuthors m
+                    ON m.correct_id = pending.correct_id
+                    AND m.guessed_id = pending.guessed_id
+                """,
+                [id for pair in chunk for id in pair],
+            )
+            entries.extend(
+                MixEntry(row[0], row[1], row[2], row[3], row[4]) for row in rows
+            )
+        return entries
+
     async def insert_mix(self, correct_id: int, guessed_id: int, times: int = 1):
-        self.cursor.execute(
+        await self.backend.shared.execute(
             "INSERT OR REPLACE INTO MixedAuthors (correct_id, guessed_id, times) VALUES (?, ?, ?)",
             (correct_id, guessed_id, times),
         )
-        self.conn.commit()
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
+
+@instrument_dao
+class QuestionDAO:
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+
+    async def insert_question(self, question: OpenQuestion):
+        choices = [[author.author_id, author.name] for author in question.choices]
+        await self.backend.shared.execute(
+            "INSERT OR REPLACE INTO questions (message_id, channel_id, guild_id, correct_id, content, choices, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                question.message_id,
+                question.channel_id,
+                question.guild_id,
+                question.correct_id,
+                question.content,
+                json.dumps(choices),
+                question.expires_at,
+            ),
+        )
+
+    async def get_question(self, message_id: int) -> OpenQuestion | None:
+        row = await self.backend.shared.fetchone(
+            "SELECT message_id, channel_id, guild_id, correct_id, content, choices, expires_at FROM questions WHERE message_id = ?",
+            (message_id,),
+        )
+        if row is None:
+            return None
+        choices = [Author(author_id, name) for author_id, name in json.loads(row[5])]
+        return OpenQuestion(row[0], row[1], row[2], row[3], row[4], choices, row[6])
+
+    async def get_question_deadlines(
+        self, shard_ids: list[int] | None = None, shard_count: int | None = None
+    ) -> list[tuple[int, float]]:
+        # Discord assigns guilds to shards by (guild_id >> 22) % shard_count.
+        if shard_ids is None or not shard_count:
+            return await self.backend.shared.fetchall(
+                "SELECT message_id, expires_at FROM questions"
+            )
+        return await self.backend.shared.fetchall(
+            "SELECT message_id, expires_at FROM questions WHERE (guild_id >> 22) % ? IN (SELECT value FROM json_each(?))",
+            (shard_count, json.dumps(shard_ids)),
+        )
+
+    async def delete_question(self, message_id: int):
+        await self.backend.shared.write(self._delete_question, message_id)
+
+    @staticmethod
+    def _delete_question(cursor: sqlite3.Cursor, message_id: int):
+        cursor.execute("DELETE FROM questions WHERE message_id = ?", (message_id,))
+        cursor.execute(
+            "DELETE FROM question_attempts WHERE message_id = ?", (message_id,)
+        )
+
+    async def get_attempts(
+        self, message_ids: list[int]
+    ) -> list[tuple[int, int, int, bool]]:
+        rows = await self.backend.shared.fetchall(
+            "SELECT message_id, player_id, tries, solved FROM question_attempts WHERE message_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(message_ids),),
+        )
+        return [(row[0], row[1], row[2], bool(row[3])) for row in rows]
+
+    async def update_attempts(self, rows: list[tuple[int, int, int, bool]]):
+        # Rows are (message_id, player_id, tries, solved). Attempts of questions
+        # closed since are not written, or nothing would ever delete them.
+        await self.backend.shared.executemany(
+            "INSERT OR REPLACE INTO question_attempts (message_id, player_id, tries, solved) SELECT ?1, ?2, ?3, ?4 WHERE EXISTS (SELECT 1 FROM questions WHERE message_id = ?1)",
+            rows,
+        )
+
+
+def group_by_guild(rows: list[tuple], guild_index: int) -> dict[int, list[tuple]]:
+    rows_by_guild = {}
+    for row in rows:
+        rows_by_guild.setdefault(row[guild_index], []).append(row)
+    return rows_by_guild
+
+
+async def get_guild_author_ids(backend: StorageBackend, guild_id: int) -> list[int]:
+    # GuildAuthors and the shared tables may be in different files, so queries
+    # over both take the guild's author ids along as a JSON array.
+    rows = await backend.guild(guild_id).fetchall(
+        "SELECT author_id FROM GuildAuthors WHERE guild_id = ?", (guild_id,)
+    )
+    return [row[0] for row in rows]
 
 
 database = "database.db"
 
-message_dao = MessageDAO(database)
-message_dao.create_table()
+backend = create_backend(database)
+
+message_dao = MessageDAO(backend)
+message_bucket_dao = MessageBucketDAO(backend)
+author_dao = AuthorDAO(backend)
+channel_dao = TextChannelDAO(backend)
+guild_author_dao = GuildAuthorDAO(backend)
+guild_player_dao = GuildPlayerDAO(backend)
+mixed_author_dao = MixedAuthorDAO(backend)
+question_dao = QuestionDAO(backend)
+
+
+def use_backend(new_backend: StorageBackend):
+    # Swaps the backend of every DAO, e.g. for an in-memory one in benchmarks.
+    global backend
 
-author_dao = AuthorDAO(database)
-author_dao.create_table()
+    backend = new_backend
+    for dao in (
+        message_dao,
+        message_bucket_dao,
+        author_dao,
+        channel_dao,
+        guild_author_dao,
+        guild_player_dao,
+        mixed_author_dao,
+        question_dao,
+    ):
+        dao.backend = new_backend
 
-channel_dao = TextChannelDAO(database)
-channel_dao.create_table()
 
-guild_author_dao = GuildAuthorDAO(database)
-guild_author_dao.create_table()
+def init_database():
+    backend.open()
 
-player_dao = PlayerDAO(database)
-player_dao.create_table()
 
-mixed_author_dao = MixedAuthorDAO(database)
-mixed_author_dao.create_table()
+def close_database():
+    backend.close()
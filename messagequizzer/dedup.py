@@ -0,0 +1,53 @@
+import hashlib
+import re
+import struct
+
+from messagequizzer.config import *
+
+WORD = re.compile(r"\w+")
+SIGNATURE = struct.Struct(f"<{MINHASH_BANDS * MINHASH_ROWS}I")
+
+
+def hash64(data: bytes) -> int:
+    # Signed, so it fits in an SQLite INTEGER.
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True
+    )
+
+
+def normalize(content: str) -> list[str]:
+    # Case, punctuation and spacing changes do not make a message new.
+    return WORD.findall(content.lower())
+
+
+def shingles(words: list[str]) -> set[str]:
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {
+        " ".join(words[start : start + SHINGLE_SIZE])
+        for start in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def minhash(words: list[str]) -> list[int]:
+    # One extendable-output hash per shingle gives all of its 32-bit hash
+    # values at once, and the signature is their minimum per position.
+    shingle_hashes = [
+        SIGNATURE.unpack(hashlib.shake_128(shingle.encode()).digest(SIGNATURE.size))
+        for shingle in shingles(words)
+    ]
+    return list(map(min, zip(*shingle_hashes)))
+
+
+def content_buckets(content: str) -> list[int]:
+    # One bucket for the exact normalized text and one per LSH band of the
+    # MinHash signature. Messages sharing any bucket are duplicates; with the
+    # default 8 bands of 4 rows that means a word-shingle Jaccard similarity
+    # of about 0.6 or more.
+    words = normalize(content)
+    buckets = [hash64(b"exact\0" + " ".join(words).encode())]
+    signature = minhash(words)
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS : (band + 1) * MINHASH_ROWS]
+        buckets.append(hash64(struct.pack(f"<{MINHASH_ROWS + 1}I", band, *rows)))
+    return buckets
@@ -0,0 +1,156 @@
+from collections import Counter
+from typing import Callable
+import asyncio
+
+from messagequizzer.database import (
+    GuildPlayerDAO,
+    MixedAuthorDAO,
+    QuestionDAO,
+    group_by_guild,
+)
+from messagequizzer.metrics import FLUSH_LATENCY, FLUSH_ROWS
+
+
+class GameEventBuffer:
+    # Coalesces answer, mix and attempt events from button clicks in memory and
+    # writes them as UPSERT batches every interval seconds, one per guild for
+    # the scores, one for the mixes and one for the attempts. Batches that fail
+    # are put back for the next flush, the ones already written are not.
+    def __init__(
+        self,
+        guild_player_dao: GuildPlayerDAO,
+        mixed_author_dao: MixedAuthorDAO,
+        question_dao: QuestionDAO,
+        interval: float,
+        on_flush: Callable[[], None] = lambda: None,
+    ):
+        self.guild_player_dao = guild_player_dao
+        self.mixed_author_dao = mixed_author_dao
+        self.question_dao = question_dao
+        self.interval = interval
+        self.on_flush = on_flush
+        # Score deltas are keyed by (guild_id, player_id), with the latest
+        # name of each player next to them.
+        self.score_deltas: dict[tuple[int, int], tuple[int, int]] = {}
+        self.player_names: dict[int, str] = {}
+        self.mix_deltas: Counter[tuple[int, int]] = Counter()
+        # Latest (tries, solved) per (message_id, player_id).
+        self.attempts: dict[tuple[int, int], tuple[int, bool]] = {}
+        self.flushing_score_deltas: dict[tuple[int, int], tuple[int, int]] = {}
+        self.flushing_player_names: dict[int, str] = {}
+        self.flushing_mix_deltas: Counter[tuple[int, int]] = Counter()
+        self.task: asyncio.Task | None = None
+
+    def record_answer(
+        self, guild_id: int, player_id: int, name: str, try_count: int
+    ) -> None:
+        add_score_delta(self.score_deltas, (guild_id, player_id), 1, try_count)
+        self.player_names[player_id] = name
+
+    def record_mix(self, correct_id: int, guessed_id: int, increase: int = 1) -> None:
+        self.mix_deltas[(correct_id, guessed_id)] += increase
+
+    def record_attempt(
+        self, message_id: int, player_id: int, tries: int, solved: bool
+    ) -> None:
+        self.attempts[(message_id, player_id)] = (tries, solved)
+
+    def pending_mix_deltas(self) -> Counter[tuple[int, int]]:
+        return self.flushing_mix_deltas + self.mix_deltas
+
+    def has_pending(self) -> bool:
+        return bool(self.score_deltas or self.mix_deltas or self.attempts)
+
+    async def flush(self) -> None:
+        if not self.has_pending():
+            return
+        self.flushing_score_deltas = self.score_deltas
+        self.flushing_player_names = self.player_names
+        self.flushing_mix_deltas = self.mix_deltas
+        self.score_deltas = {}
+        self.player_names = {}
+        self.mix_deltas = Counter()
+        attempts = self.attempts
+        self.attempts = {}
+        player_deltas = [
+            (guild_id, player_id, self.flushing_player_names[player_id], score, tries)
+            for (guild_id, player_id), (
+                score,
+                tries,
+            ) in self.flushing_score_deltas.items()
+        ]
+        mix_deltas = [
+            (correct_id, guessed_id, times)
+            for (correct_id, guessed_id), times in self.flushing_mix_deltas.items()
+        ]
+        unwritten_deltas = group_by_guild(player_deltas, 0)
+        mixes_written = False
+        attempts_written = False
+        try:
+            with FLUSH_LATENCY.time(buffer="game_events"):
+                for guild_id, guild_deltas in list(unwritten_deltas.items()):
+                    await self.guild_player_dao.update_players(guild_deltas)
+                    del unwritten_deltas[guild_id]
+                await self.mixed_author_dao.increase_mixes(mix_deltas)
+                mixes_written = True
+                await self.question_dao.update_attempts(
+                    [
+                        (message_id, player_id, tries, solved)
+                        for (message_id, player_id), (tries, solved) in attempts.items()
+                    ]
+                )
+                attempts_written = True
+        except BaseException:
+            for guild_deltas in unwritten_deltas.values():
+                for guild_id, player_id, _, score, total_tries in guild_deltas:
+                    add_score_delta(
+                        self.score_deltas, (guild_id, player_id), score, total_tries
+                    )
+            self.player_names = {**self.flushing_player_names, **self.player_names}
+            if not mixes_written:
+                self.mix_deltas.update(self.flushing_mix_deltas)
+            if not attempts_written:
+                # Clicks since the flush started are newer.
+                self.attempts = {**attempts, **self.attempts}
+            raise
+        else:
+            FLUSH_ROWS.observe(len(player_deltas), table="GuildPlayers")
+            FLUSH_ROWS.observe(len(mix_deltas), table="MixedAuthors")
+            FLUSH_ROWS.observe(len(attempts), table="question_attempts")
+            self.on_flush()
+        finally:
+            self.flushing_score_deltas = {}
+            self.flushing_player_names = {}
+            self.flushing_mix_deltas = Counter()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as exception:
+                print(f"Failed to write game events: {exception!r}")
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+
+def add_score_delta(
+    deltas: dict[tuple[int, int], tuple[int, int]],
+    key: tuple[int, int],
+    score: int,
+    total_tries: int,
+) -> None:
+    pending_score, pending_total_tries = deltas.get(key, (0, 0))
+    deltas[key] = (pending_score + score, pending_total_tries + total_tries)
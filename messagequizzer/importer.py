@@ -0,0 +1,258 @@
+from dataclasses import dataclass, field
+from multiprocessing.queues import Queue
+from types import SimpleNamespace
+from typing import Iterator, TextIO
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import time
+
+from messagequizzer.buffer import PendingHistory
+from messagequizzer.config import *
+from messagequizzer.message_handler import (
+    get_checkpoint,
+    is_message_qualified,
+    store_history,
+)
+
+DECODER = json.JSONDecoder()
+NON_WHITESPACE = re.compile(r"\S")
+CHUNK_SIZE = 1024 * 1024  # characters read from an export at a time
+IMPORTED_MESSAGE_TYPES = {"Default", "Reply"}
+
+batch_queue: Queue | None = None
+
+
+class JsonStream:
+    # Decodes one JSON value at a time from a file, keeping only the part of
+    # the file that has not been decoded yet in memory.
+    def __init__(self, file: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+
+    def fill(self) -> bool:
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position :] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            match = NON_WHITESPACE.search(self.buffer, self.position)
+            if match:
+                self.position = match.start()
+                return self.buffer[self.position]
+            self.position = len(self.buffer)
+            if not self.fill():
+                raise ValueError("Unexpected end of the export")
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            context = self.buffer[self.position : self.position + 20]
+            raise ValueError(f"Expected {char!r} at {context!r}")
+        self.position += 1
+
+    def skip(self, char: str) -> None:
+        if self.peek() == char:
+            self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number cut off by the end of the chunk still decodes.
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+
+def open_export(file: TextIO) -> tuple[dict, Iterator[dict]]:
+    # DiscordChatExporter writes the guild and channel before the messages, so
+    # the header is complete once the messages array starts.
+    stream = JsonStream(file)
+    stream.expect("{")
+    header = {}
+    while stream.peek() != "}":
+        key = stream.value()
+        stream.expect(":")
+        if key == "messages":
+            stream.expect("[")
+            return header, iter_array(stream)
+        header[key] = stream.value()
+        stream.skip(",")
+    return header, iter(())
+
+
+def iter_array(stream: JsonStream) -> Iterator[dict]:
+    while stream.peek() != "]":
+        yield stream.value()
+        stream.skip(",")
+
+
+def is_export_message_qualified(message: dict) -> bool:
+    if message.get("type", "Default") not in IMPORTED_MESSAGE_TYPES:
+        return False
+    # Stands in for the discord.Message the live filter expects.
+    author = SimpleNamespace(bot=message["author"].get("isBot", False))
+    return is_message_qualified(
+        SimpleNamespace(author=author, content=message["content"])
+    )
+
+
+def set_batch_queue(queue: Queue) -> None:
+    global batch_queue
+
+    batch_queue = queue
+
+
+@dataclass
+class ExportBatch:
+    history: PendingHistory = field(default_factory=PendingHistory)
+    buckets: dict[int, list[list[int]]] = field(default_factory=dict)
+    messages_read: int = 0
+    path: str | None = None  # set on the last batch of a file
+    error: str | None = None
+    first_message_id: int | None = None  # of the file, on its last batch
+    from_start: bool = False  # the file has the channel's oldest messages
+
+
+def parse_export(path: str, batch_size: int) -> None:
+    # Runs in a worker process and sends the qualified messages of one export
+    # to the importing process in batches, with their duplicate detection
+    # buckets already computed. The channel checkpoint only goes out with the
+    # last batch, after every message before it.
+    batch = ExportBatch()
+    first_message_id = None
+    from_start = False
+    try:
+        with open(path, encoding="utf-8") as file:
+            header, messages = open_export(file)
+            guild_id = int(header["guild"]["id"])
+            channel_id = int(header["channel"]["id"])
+            if guild_id == 0:
+                raise ValueError("not a guild channel export")
+            # Exports without a date range are from an exporter that does not
+            # say, so they are treated like partial ones.
+            date_range = header.get("dateRange")
+            from_start = date_range is not None and date_range.get("after") is None
+            last_message_id = None
+            for message in messages:
+                batch.messages_read += 1
+                message_id = int(message["id"])
+                last_message_id = max(message_id, last_message_id or 0)
+                first_message_id = min(message_id, first_message_id or message_id)
+                if not is_export_message_qualified(message):
+                    continue
+                author = message["author"]
+                batch.history.add_message(
+                    message_id,
+                    int(author["id"]),
+                    author["name"],
+                    guild_id,
+                    message["content"],
+                )
+                if batch.history.message_count >= batch_size:
+                    batch.buckets = batch.history.content_buckets()
+                    batch_queue.put(batch)
+                    batch = ExportBatch()
+            if last_message_id is not None:
+                batch.history.set_checkpoint(guild_id, channel_id, last_message_id)
+    except Exception as exception:
+        batch.error = repr(exception)
+    batch.path = path
+    batch.first_message_id = first_message_id
+    batch.from_start = from_start
+    batch.buckets = batch.history.content_buckets()
+    batch_queue.put(batch)
+
+
+@dataclass
+class ImportProgress:
+    files_total: int
+    files_done: int = 0
+    files_failed: int = 0
+    messages_read: int = 0
+    messages_imported: int = 0
+    started_at: float = field(default_factory=time.time)
+
+    def __str__(self) -> str:
+        elapsed = time.time() - self.started_at
+        rate = self.messages_read / elapsed if elapsed > 0 else 0.0
+        return (
+            f"{self.files_done + self.files_failed}/{self.files_total} files, "
+            f"{self.messages_imported}/{self.messages_read} messages imported "
+            f"({rate:.0f} msg/s), {self.files_failed} failed"
+        )
+
+
+def find_exports(paths: list[str]) -> list[str]:
+    exports = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                exports.extend(
+                    os.path.join(directory, name)
+                    for name in sorted(names)
+                    if name.endswith(".json")
+                )
+        else:
+            exports.append(path)
+    return exports
+
+
+async def drop_uncovered_checkpoints(batch: ExportBatch) -> None:
+    # A partial export only moves the checkpoint when it starts at or before
+    # it; otherwise the crawler still has to read what comes between them.
+    for guild_id, channel_id in list(batch.history.channels):
+        checkpoint = await get_checkpoint(guild_id, channel_id)
+        if checkpoint is None or batch.first_message_id > checkpoint:
+            del batch.history.channels[(guild_id, channel_id)]
+
+
+async def import_exports(
+    paths: list[str],
+    processes: int = IMPORT_PROCESSES,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> ImportProgress:
+    # Exports are parsed in parallel by worker processes and written here, one
+    # transaction per batch, through the same path as the live flusher.
+    exports = find_exports(paths)
+    progress = ImportProgress(files_total=len(exports))
+    if not exports:
+        return progress
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue(maxsize=2 * processes)
+    with context.Pool(processes, set_batch_queue, (queue,)) as pool:
+        parsing = pool.starmap_async(
+            parse_export, [(path, batch_size) for path in exports], chunksize=1
+        )
+        while progress.files_done + progress.files_failed < len(exports):
+            batch = await asyncio.to_thread(queue.get)
+            if batch.history.channels and not batch.from_start:
+                await drop_uncovered_checkpoints(batch)
+            stored_counts = await store_history(batch.history, batch.buckets)
+            progress.messages_read += batch.messages_read
+            # Duplicates and messages imported before are not stored again.
+            progress.messages_imported += sum(stored_counts.values())
+            if batch.path is None:
+                continue
+            if batch.error is None:
+                progress.files_done += 1
+            else:
+                progress.files_failed += 1
+                print(f"Failed to import {batch.path}: {batch.error}")
+            print(f"Importing: {progress}")
+        parsing.get()
+    return progress
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import asyncio
+
+from messagequizzer.config import *
+from messagequizzer.database import GuildPlayerDAO, ScoreboardEntry
+
+
+def rank(entry: ScoreboardEntry) -> tuple[float, int]:
+    return (entry.average_guess, entry.player_id)
+
+
+class GuildBoard:
+    __slots__ = ("entries", "complete")
+
+    def __init__(self, entries: list[ScoreboardEntry], complete: bool):
+        self.entries = entries  # best first, up to the board's capacity
+        self.complete = complete  # every player of the guild is in entries
+
+
+class Leaderboard:
+    # Keeps the best players of each guild in memory, updated on every
+    # correct answer, so !scores only copies the first size entries. A board
+    # holds up to twice that many. Unless it lists every player of the guild,
+    # a player falling to its end leaves it, since someone off the board may
+    # rank in between; once fewer than size are left it is reloaded from the
+    # index on the next read.
+    #
+    # Players with answers that are not flushed yet have their up to date
+    # stats in players, which wins over what a board reload reads.
+    def __init__(
+        self,
+        guild_player_dao: GuildPlayerDAO,
+        size: int = LEADERBOARD_SIZE,
+        max_guilds: int = LEADERBOARD_MAX_GUILDS,
+    ):
+        self.guild_player_dao = guild_player_dao
+        self.size = size
+        self.capacity = 2 * size
+        self.max_guilds = max_guilds
+        self.boards: OrderedDict[int, GuildBoard] = OrderedDict()
+        self.board_loads: dict[int, asyncio.Future] = {}
+        self.players: dict[tuple[int, int], ScoreboardEntry] = {}
+        self.player_loads: dict[tuple[int, int], asyncio.Future] = {}
+
+    async def get(self, guild_id: int) -> list[ScoreboardEntry]:
+        board = self.boards.get(guild_id)
+        if board is None:
+            load = self.board_loads.get(guild_id)
+            if load is None:
+                load = asyncio.ensure_future(self.load_board(guild_id))
+                self.board_loads[guild_id] = load
+                load.add_done_callback(lambda _: self.board_loads.pop(guild_id, None))
+            board = await asyncio.shield(load)
+        else:
+            self.boards.move_to_end(guild_id)
+        return board.entries[: self.size]
+
+    async def load_board(self, guild_id: int) -> GuildBoard:
+        # Enough rows that the cached players replacing theirs cannot push
+        # anyone who belongs on the board out of them.
+        limit = self.capacity + sum(key[0] == guild_id for key in self.players)
+        entries = await self.guild_player_dao.get_scoreboard_by_guild(guild_id, limit)
+        complete = len(entries) < limit
+        entries_by_id = {entry.player_id: entry for entry in entries}
+        for (player_guild_id, player_id), entry in self.players.items():
+            if player_guild_id == guild_id:
+                entries_by_id[player_id] = entry
+        entries = sorted(entries_by_id.values(), key=rank)
+        board = GuildBoard(
+            entries[: self.capacity], complete and len(entries) <= self.capacity
+        )
+        self.boards[guild_id] = board
+        while len(self.boards) > self.max_guilds:
+            self.boards.popitem(last=False)
+        return board
+
+    async def get_player(
+        self, guild_id: int, player_id: int, name: str
+    ) -> ScoreboardEntry:
+        key = (guild_id, player_id)
+        entry = self.players.get(key)
+        if entry is not None:
+            return entry
+        # Concurrent answers of one player share one load, so neither of them
+        # can overwrite stats the other one already counted.
+        load = self.player_loads.get(key)
+        if load is None:
+            load = asyncio.ensure_future(
+                self.guild_player_dao.get_scoreboard_entry(guild_id, player_id)
+            )
+            self.player_loads[key] = load
+            load.add_done_callback(lambda _: self.player_loads.pop(key, None))
+        stored = await asyncio.shield(load)
+        return self.players.setdefault(
+            key, stored or ScoreboardEntry(player_id, name, 0, 0)
+        )
+
+    async def record_answer(
+        self, guild_id: int, player_id: int, name: str, try_count: int
+    ) -> None:
+        entry = await self.get_player(guild_id, player_id, name)
+        entry.name = name
+        entry.score += 1
+        entry.total_tries += try_count
+        board = self.boards.get(guild_id)
+        if board is None:
+            return
+        entries = [other for other in board.entries if other.player_id != player_id]
+        entries.append(entry)
+        entries.sort(key=rank)
+        if len(entries) > self.capacity:
+            board.complete = False
+            del entries[self.capacity :]
+        elif not board.complete and entries[-1] is entry:
+            # Players off the board may rank between the others and this one.
+            entries.pop()
+        board.entries = entries
+        if len(entries) < self.size and not board.complete:
+            self.boards.pop(guild_id)
+
+    def forget_flushed(self, pending: set[tuple[int, int]]) -> None:
+        # Stored rows are up to date for everyone without unflushed answers.
+        for key in [key for key in self.players if key not in pending]:
+            del self.players[key]
+
+    def clear(self) -> None:
+        self.boards.clear()
@@ -1,17 +1,105 @@
-from collections import defaultdict
+from collections import Counter
+import asyncio
 import time
 import random
 import discord
 
 from messagequizzer.database import *
+from messagequizzer.buffer import PendingHistory
+from messagequizzer.cache import TTLCache
 from messagequizzer.config import *
+from messagequizzer.game_events import GameEventBuffer
+from messagequizzer.leaderboard import Leaderboard
+from messagequizzer.metrics import FLUSH_LATENCY, FLUSH_ROWS, registry
+from messagequizzer.questions import PreparedQuestion, QuestionQueue
+from messagequizzer.retention import RetentionPolicy
+from messagequizzer.roster import RosterCache
 
 
-short_term_message_memory = defaultdict(list)
-short_term_author_memory = {}
-short_term_channel_memory = {}
-short_term_guild_author_memory = []
-last_time_written = time.time()
+pending_history = PendingHistory()
+flushing_history = PendingHistory()
+oldest_pending_time: float | None = None
+flush_requested = asyncio.Event()
+flush_finished = asyncio.Event()
+flusher_task: asyncio.Task | None = None
+roster_cache = RosterCache(guild_author_dao, message_dao, mixed_author_dao)
+leaderboard = Leaderboard(guild_player_dao)
+mix_board_cache = TTLCache(LEADERBOARD_CACHE_TTL)
+
+
+def clear_leaderboards() -> None:
+    leaderboard.clear()
+    mix_board_cache.clear()
+
+
+def on_game_events_flushed() -> None:
+    mix_board_cache.clear()
+    leaderboard.forget_flushed(set(game_events.score_deltas))
+
+
+game_events = GameEventBuffer(
+    guild_player_dao,
+    mixed_author_dao,
+    question_dao,
+    GAME_EVENT_FLUSH_INTERVAL,
+    on_flush=on_game_events_flushed,
+)
+
+
+async def record_answer(
+    guild_id: int, player_id: int, name: str, try_count: int
+) -> None:
+    # The buffer gets the answer in the same step the leaderboard counts it,
+    # so a flush cannot store it before the leaderboard has loaded the
+    # player's stored stats.
+    await leaderboard.record_answer(guild_id, player_id, name, try_count)
+    game_events.record_answer(guild_id, player_id, name, try_count)
+
+
+def record_attempt(message_id: int, player_id: int, tries: int, solved: bool) -> None:
+    game_events.record_attempt(message_id, player_id, tries, solved)
+
+
+def record_mix(guild_id: int, correct_id: int, guessed_id: int) -> None:
+    game_events.record_mix(correct_id, guessed_id)
+    roster_cache.add_mix(guild_id, correct_id, guessed_id)
+
+
+PENDING_MESSAGES = registry.gauge(
+    "messagequizzer_pending_messages",
+    "Messages buffered for the next flush.",
+    lambda: pending_history.message_count,
+)
+registry.gauge(
+    "messagequizzer_pending_authors",
+    "Author names buffered for the next flush.",
+    lambda: len(pending_history.authors),
+)
+registry.gauge(
+    "messagequizzer_pending_channels",
+    "Channel checkpoints buffered for the next flush.",
+    lambda: len(pending_history.channels),
+)
+registry.gauge(
+    "messagequizzer_pending_guild_authors",
+    "Guild and author pairs buffered for the next flush.",
+    lambda: len(pending_history.guild_authors),
+)
+PENDING_BYTES = registry.gauge(
+    "messagequizzer_pending_bytes",
+    "Estimated memory held by the pending history buffer.",
+    lambda: pending_history.estimated_bytes,
+)
+registry.gauge(
+    "messagequizzer_prepared_questions",
+    "Questions waiting in the per-guild prefetch queues.",
+    lambda: len(question_queue),
+)
+registry.gauge(
+    "messagequizzer_pending_game_events",
+    "Players and mixes with unflushed score or mix deltas.",
+    lambda: len(game_events.score_deltas) + len(game_events.mix_deltas),
+)
 
 
 def is_message_qualified(message: discord.Message):
@@ -26,68 +114,306 @@ def convert_message(message: discord.Message) -> Message:
     return Message(message.id, message.author.id, message.guild.id, message.content)
 
 
-def add_message(message: discord.Message, update_last_read: bool) -> None:
-    if update_last_read:
-        # problematic
-        short_term_channel_memory[message.channel.id] = datetime.datetime.now()
-    short_term_author_memory[message.author.id] = message.author.name
-    short_term_message_memory[message.guild.id].append(convert_message(message))
-    short_term_guild_author_memory.append(
-        GuildAuthor(message.guild.id, message.author.id)
+def add_message(message: discord.Message) -> None:
+    pending_history.add_message(
+        message.id,
+        message.author.id,
+        message.author.name,
+        message.guild.id,
+        message.content,
+    )
+    roster_cache.add_author(message.guild.id, message.author.id, message.author.name)
+    mark_pending()
+
+
+def is_buffer_full() -> bool:
+    return (
+        pending_history.message_count >= DATABASE_UPDATE_MAX_BUFFER_SIZE
+        or pending_history.estimated_bytes >= DATABASE_UPDATE_MAX_BUFFER_BYTES
     )
 
 
-def should_write_history() -> bool:
-    return time.time() - last_time_written > DATABASE_UPDATE_COOLDOWN
+def mark_pending() -> None:
+    global oldest_pending_time
 
+    if oldest_pending_time is None:
+        oldest_pending_time = time.time()
+    if is_buffer_full():
+        flush_requested.set()
 
-async def read_history(channel: discord.TextChannel, limit=None) -> None:
-    after: datetime.datetime = None
 
-    if channel.id in short_term_channel_memory:
-        after = short_term_channel_memory[channel.id]
-    else:
-        channel_db = channel_dao.get_channel_by_id(channel.id)
-        if channel_db:
-            after = channel_db.last_read
-    async for message in channel.history(limit=limit, after=after):
+def has_pending_history() -> bool:
+    return bool(pending_history)
+
+
+async def wait_for_buffer_room() -> None:
+    # Backpressure for catch-up: stop reading once the buffer is twice the
+    # flush size or over its memory cap, until the flusher has drained it.
+    while (
+        pending_history.message_count >= 2 * DATABASE_UPDATE_MAX_BUFFER_SIZE
+        or pending_history.estimated_bytes >= DATABASE_UPDATE_MAX_BUFFER_BYTES
+    ):
+        flush_finished.clear()
+        flush_requested.set()
+        await flush_finished.wait()
+
+
+async def get_checkpoint(guild_id: int, channel_id: int) -> int | None:
+    if (guild_id, channel_id) in pending_history.channels:
+        return pending_history.channels[(guild_id, channel_id)]
+    channel_db = await channel_dao.get_channel_by_id(guild_id, channel_id)
+    if channel_db:
+        return channel_db.last_message_id
+    return None
+
+
+async def read_history(channel: discord.TextChannel, limit=None) -> int:
+    # The checkpoint is the id of the last message processed in the channel.
+    # It sits in the same buffer as the messages before it, so both are
+    # flushed in one transaction and a restart resumes right after it.
+    checkpoint = await get_checkpoint(channel.guild.id, channel.id)
+    after = discord.Object(id=checkpoint) if checkpoint else None
+
+    read_count = 0
+    async for message in channel.history(limit=limit, after=after, oldest_first=True):
+        read_count += 1
         if is_message_qualified(message):
-            add_message(message, True)
+            add_message(message)
+        pending_history.set_checkpoint(channel.guild.id, channel.id, message.id)
+        mark_pending()
 
-            if should_write_history():
-                await write_history()
+        await wait_for_buffer_room()
     print(f"Finished reading #{channel.name} of {channel.guild.name}!")
+    return read_count
+
 
 async def get_author_guild_pairs(messages: list[Message]) -> list[tuple[int, int]]:
     return [(message.author_id, message.guild_id) for message in messages]
 
 
 async def write_history() -> None:
-    global last_time_written
+    global pending_history, flushing_history, oldest_pending_time
 
     print("Updating the database...")
 
-    for messages in short_term_message_memory.values():
-        await message_dao.insert_messages(messages)
-        await author_dao.insert_authors(short_term_author_memory)
-        await channel_dao.insert_channels(short_term_channel_memory)
-        await guild_author_dao.insert_authors_to_guilds(short_term_guild_author_memory)
-        last_time_written = time.time()
-        short_term_author_memory.clear()
-        short_term_channel_memory.clear()
+    # Swap the buffer before the first await, so messages that arrive while
+    # the writes are running wait for the next flush instead of being dropped.
+    history = flushing_history = pending_history
+    pending_history = PendingHistory()
+    oldest_pending_time = None
+
+    try:
+        with FLUSH_LATENCY.time(buffer="history"):
+            stored_counts = await store_history(history)
+    except BaseException:
+        # Put the failed flush back in front of whatever was buffered since,
+        # so the next flush retries it and checkpoints never run ahead of
+        # their messages.
+        pending_history.restore(history)
+        mark_pending()
+        raise
+    else:
+        FLUSH_ROWS.observe(history.message_count, table="messages")
+        FLUSH_ROWS.observe(len(history.authors), table="authors")
+        FLUSH_ROWS.observe(len(history.channels), table="channels")
+        FLUSH_ROWS.observe(len(history.guild_authors), table="GuildAuthors")
+        for guild_id, author_id in history.guild_authors:
+            roster_cache.add_author(guild_id, author_id, history.authors[author_id])
+        for (guild_id, author_id), count in stored_counts.items():
+            roster_cache.add_messages(guild_id, author_id, count)
+    finally:
+        flushing_history = PendingHistory()
+
+
+async def store_history(
+    history: PendingHistory, buckets: dict[int, list[list[int]]] | None = None
+) -> Counter[tuple[int, int]]:
+    # Returns how many new messages were stored per guild and author,
+    # duplicates and messages stored before left out. Author names go to the
+    # shared storage first; everything else is written in one transaction per
+    # guild, so a guild's checkpoints never land without the messages before
+    # them.
+    if buckets is None:
+        buckets = await asyncio.to_thread(history.content_buckets)
+    guild_channels: dict[int, dict[int, int]] = {}
+    for (guild_id, channel_id), message_id in history.channels.items():
+        guild_channels.setdefault(guild_id, {})[channel_id] = message_id
+    guild_authors: dict[int, list[GuildAuthor]] = {}
+    for guild_id, author_id in history.guild_authors:
+        guild_authors.setdefault(guild_id, []).append(GuildAuthor(guild_id, author_id))
+
+    await author_dao.insert_authors(history.authors)
+    stored_counts = Counter()
+    for guild_id in {*history.guild_messages, *guild_channels, *guild_authors}:
+        new_message_ids = []
+        async with message_dao.backend.guild(guild_id).transaction():
+            messages = history.messages_of(guild_id)
+            if messages is not None:
+                rows = await message_bucket_dao.claim_unique_rows(
+                    guild_id, messages.rows(guild_id), buckets[guild_id]
+                )
+                new_message_ids = await message_dao.insert_message_rows(guild_id, rows)
+                new_ids = set(new_message_ids)
+                stored_counts.update(
+                    (guild_id, row[1]) for row in rows if row[0] in new_ids
+                )
+            await channel_dao.insert_channels(
+                guild_id, guild_channels.get(guild_id, {})
+            )
+            await guild_author_dao.insert_authors_to_guilds(
+                guild_authors.get(guild_id, [])
+            )
+        # Only now that they are committed; a failed transaction is retried.
+        message_dao.add_to_index(guild_id, new_message_ids)
+    return stored_counts
+
+
+async def run_flusher() -> None:
+    # Flushes when the buffer reaches DATABASE_UPDATE_MAX_BUFFER_SIZE messages
+    # or when its oldest entry is DATABASE_UPDATE_COOLDOWN seconds old.
+    while True:
+        timeout = DATABASE_UPDATE_COOLDOWN
+        if oldest_pending_time is not None:
+            timeout -= time.time() - oldest_pending_time
+        try:
+            await asyncio.wait_for(flush_requested.wait(), timeout=max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        flush_requested.clear()
+        if has_pending_history():
+            try:
+                await write_history()
+            except Exception as exception:
+                print(f"Failed to update the database: {exception!r}")
+                await asyncio.sleep(1)
+        flush_finished.set()
+
+
+def start_flusher() -> None:
+    global flusher_task
+
+    if flusher_task is None or flusher_task.done():
+        flusher_task = asyncio.create_task(run_flusher())
+
+
+async def stop_flusher() -> None:
+    global flusher_task
+
+    if flusher_task is not None:
+        flusher_task.cancel()
+        try:
+            await flusher_task
+        except asyncio.CancelledError:
+            pass
+        flusher_task = None
+    if has_pending_history():
+        await write_history()
+
+
+async def get_author(message: Message) -> Author:
+    for history in (pending_history, flushing_history):
+        if message.author_id in history.authors:
+            return Author(message.author_id, history.authors[message.author_id])
+    return await author_dao.get_author_by_id(message.author_id)
+
 
-    short_term_message_memory.clear()
+async def get_random_message(guild_id: int) -> Message:
+    # Sample uniformly over the stored rows and the ones still waiting for a flush.
+    stored_count = await message_dao.get_message_count_by_guild_id(guild_id)
+    pending_messages = pending_history.messages_of(guild_id)
+    pending_count = len(pending_messages) if pending_messages else 0
+    total_count = stored_count + pending_count
+    if total_count == 0:
+        return None
+    index = random.randrange(total_count)
+    if index < stored_count:
+        return await message_dao.get_message_by_guild_index(guild_id, index)
+    return pending_messages.get(guild_id, index - stored_count)
 
 
-def get_author(message: Message) -> Author:
-    if message.author_id in short_term_author_memory:
-        return Author(message.author_id, short_term_author_memory[message.author_id])
+async def prepare_question(
+    guild_id: int, keyword: str | None = None
+) -> PreparedQuestion | None:
+    # Keyword questions only come from stored messages, the search index does
+    # not cover the ones waiting for a flush.
+    if keyword is None:
+        message = await get_random_message(guild_id)
     else:
-        return author_dao.get_author_by_id(message.author_id)
+        message = await message_dao.get_random_message_by_keyword(guild_id, keyword)
+    if message is None:
+        return None
+    correct_author = await get_author(message)
+    roster = await roster_cache.get(guild_id)
+    choices = roster.sample(NUMBER_OF_FALSE_ANSWERS, correct_author.author_id)
+    choices.append(correct_author)
+    random.shuffle(choices)
+    return PreparedQuestion(message, correct_author, choices)
 
 
-def get_random_message(guild_id: int) -> Message:
-    message = message_dao.get_random_message_by_guild_id(guild_id)
-    if message == None and guild_id in short_term_message_memory:
-        message = random.choice(short_term_message_memory[guild_id])
-    return message
+def is_question_current(question: PreparedQuestion) -> bool:
+    # Authors may have been renamed since the question was prepared; a cached
+    # roster always has their latest names.
+    roster = roster_cache.peek(question.message.guild_id)
+    if roster is None:
+        return True
+    return all(
+        roster.names.get(author.author_id, author.name) == author.name
+        for author in question.choices
+    )
+
+
+question_queue = QuestionQueue(prepare_question, is_question_current)
+
+
+def forget_removed_messages(guild_id: int) -> None:
+    # Queued questions may be about removed messages, and the roster's
+    # activity weights still count them until it is reloaded.
+    question_queue.invalidate_guild(guild_id)
+    roster_cache.forget_guild(guild_id)
+
+
+def forget_guild(guild_id: int) -> None:
+    # The guild's stored rows stay, in case the bot is added back.
+    message_dao.sampler.forget_guild(guild_id)
+    roster_cache.forget_guild(guild_id)
+
+
+retention = RetentionPolicy(
+    message_dao,
+    message_bucket_dao,
+    guild_author_dao,
+    on_removed=forget_removed_messages,
+)
+
+
+async def get_scoreboard(guild_id: int) -> list[ScoreboardEntry]:
+    return await leaderboard.get(guild_id)
+
+
+async def get_mix_board(guild_id: int) -> list[MixEntry]:
+    entries = await mix_board_cache.get(
+        guild_id,
+        lambda: mixed_author_dao.get_mix_board_by_guild(guild_id, LEADERBOARD_SIZE),
+    )
+    mix_deltas = game_events.pending_mix_deltas()
+    if not mix_deltas:
+        return entries
+
+    entries_by_ids = {(entry.correct_id, entry.guessed_id): entry for entry in entries}
+    for entry in await mixed_author_dao.get_mix_entries_by_ids(
+        guild_id, list(mix_deltas)
+    ):
+        entries_by_ids[(entry.correct_id, entry.guessed_id)] = entry
+    mix_deltas = game_events.pending_mix_deltas()
+    merged_entries = [
+        MixEntry(
+            entry.correct_id,
+            entry.correct_name,
+            entry.guessed_id,
+            entry.guessed_name,
+            entry.times + mix_deltas[(entry.correct_id, entry.guessed_id)],
+        )
+        for entry in entries_by_ids.values()
+    ]
+    merged_entries.sort(key=lambda entry: entry.times, reverse=True)
+    return merged_entries[:LEADERBOARD_SIZE]
@@ -0,0 +1,261 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+import asyncio
+import functools
+import inspect
+import math
+import time
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+SIZE_BUCKETS = (1, 10, 100, 1000, 5000, 10000, 50000, 100000)
+
+
+def label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key: tuple[tuple[str, str], ...], **extra: str) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    formatted = (f'{name}="{escape(value)}"' for name, value in pairs)
+    return "{" + ",".join(formatted) + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: defaultdict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self.values[label_key(labels)] += amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, {}, value
+
+
+class Gauge:
+    kind = "gauge"
+
+    # Either set explicitly or read from a callback at scrape time, which
+    # keeps buffer sizes out of the code paths that change them.
+    def __init__(
+        self, name: str, help: str, read: Callable[[], float] | None = None
+    ):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[label_key(labels)] = value
+
+    def value(self) -> float:
+        if self.read is not None:
+            return self.read()
+        return sum(self.values.values())
+
+    def samples(self):
+        if self.read is not None:
+            yield self.name, (), {}, self.read()
+            return
+        for key, value in self.values.items():
+            yield self.name, key, {}, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: defaultdict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = label_key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * len(self.buckets)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        return sum(self.counts.get(label_key(labels), ()))
+
+    def mean(self, **labels: str) -> float:
+        count = self.count(**labels)
+        return self.sums[label_key(labels)] / count if count else 0.0
+
+    def quantile(self, fraction: float, **labels: str) -> float:
+        # Upper bound of the bucket holding the quantile, as Prometheus would
+        # report it without interpolation.
+        counts = self.counts.get(label_key(labels))
+        if not counts:
+            return 0.0
+        target = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return math.inf
+
+    def label_sets(self) -> list[dict[str, str]]:
+        return [dict(key) for key in self.counts]
+
+    def samples(self):
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = {"le": format_value(bound)}
+                yield f"{self.name}_bucket", key, bucket_labels, cumulative
+            yield f"{self.name}_sum", key, {}, self.sums[key]
+            yield f"{self.name}_count", key, {}, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.started_at = time.time()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(
+        self, name: str, help: str, read: Callable[[], float] | None = None
+    ) -> Gauge:
+        return self.register(Gauge(name, help, read))
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                labels = format_labels(key, **extra)
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+COMMAND_LATENCY = registry.histogram(
+    "messagequizzer_command_seconds", "Time spent handling a message, by command."
+)
+DAO_LATENCY = registry.histogram(
+    "messagequizzer_dao_seconds", "Time spent in DAO methods, by DAO and method."
+)
+DAO_ERRORS = registry.counter(
+    "messagequizzer_dao_errors_total", "DAO calls that raised, by DAO and method."
+)
+QUERIES = registry.counter(
+    "messagequizzer_queries_total", "Storage operations run, by kind."
+)
+FLUSH_LATENCY = registry.histogram(
+    "messagequizzer_flush_seconds", "Duration of buffer flushes, by buffer."
+)
+FLUSH_ROWS = registry.histogram(
+    "messagequizzer_flush_rows", "Rows written per flush, by table.", SIZE_BUCKETS
+)
+DUPLICATES = registry.counter(
+    "messagequizzer_duplicate_messages_total",
+    "Messages dropped at ingest as exact or near duplicates.",
+)
+
+
+def instrument_dao(cls):
+    # Wraps every public coroutine method of a DAO class with a latency
+    # histogram and an error counter labelled with the class and method name.
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, timed_dao_method(cls.__name__, name, method))
+    return cls
+
+
+def timed_dao_method(dao: str, name: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DAO_ERRORS.inc(dao=dao, method=name)
+            raise
+        finally:
+            DAO_LATENCY.observe(time.perf_counter() - started, dao=dao, method=name)
+
+    return wrapper
+
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b"/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.Server:
+    server = await asyncio.start_server(handle_scrape, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
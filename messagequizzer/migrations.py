@@ -0,0 +1,290 @@
+from typing import Callable
+import sqlite3
+
+from messagequizzer.dedup import content_buckets
+from messagequizzer.storage import Storage
+
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def create_base_schema(cursor: sqlite3.Cursor):
+    # The schema as it was before versioning; a no-op on existing databases.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            author_id INTEGER,
+            guild_id INTEGER,
+            content TEXT
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS authors (
+            author_id INTEGER PRIMARY KEY,
+            display_name TEXT
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            last_read TEXT
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS GuildAuthors (
+            guild_id INTEGER,
+            author_id INTEGER,
+            PRIMARY KEY (guild_id, author_id)
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS players (
+            player_id INTEGER PRIMARY KEY,
+            score INTEGER,
+            total_tries INTEGER
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS MixedAuthors (
+            correct_id INTEGER,
+            guessed_id INTEGER,
+            times INTEGER,
+            PRIMARY KEY (correct_id, guessed_id)
+        )
+    """
+    )
+
+
+def add_channel_checkpoints(cursor: sqlite3.Cursor):
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(channels)")]
+    if "last_message_id" in columns:
+        return
+    # Older databases only stored the local time of the last read. Turn it
+    # into a snowflake a day early, so clock skew re-reads a little history
+    # instead of skipping some.
+    cursor.execute("ALTER TABLE channels ADD COLUMN last_message_id INTEGER")
+    cursor.execute(
+        """
+        UPDATE channels
+        SET last_message_id = max(
+            0,
+            (CAST(strftime('%s', last_read) AS INTEGER) - 86400) * 1000 - ?
+        ) << 22
+        WHERE last_read IS NOT NULL
+    """,
+        (DISCORD_EPOCH_MS,),
+    )
+
+
+def add_hot_query_indexes(cursor: sqlite3.Cursor):
+    # !guess loads a guild's message ids; the rowid rides along in the index.
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS messages_by_guild ON messages (guild_id)"
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS GuildAuthors_by_author
+        ON GuildAuthors (author_id, guild_id)
+    """
+    )
+    # !mixes walks the most frequent mixes first and stops at the limit.
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS MixedAuthors_by_times
+        ON MixedAuthors (times DESC, correct_id, guessed_id)
+    """
+    )
+    # !scores sorts by the average guess, so keep it as an indexed column.
+    cursor.execute(
+        """
+        ALTER TABLE players ADD COLUMN average_guess REAL
+        GENERATED ALWAYS AS (CAST(total_tries AS REAL) / score) VIRTUAL
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS players_by_average_guess
+        ON players (average_guess, player_id)
+    """
+    )
+    cursor.execute("ANALYZE")
+
+
+def add_message_buckets(cursor: sqlite3.Cursor):
+    # Duplicate detection buckets of every stored message, per guild. Stored
+    # duplicates are left in place, but their content is never stored again.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS MessageBuckets (
+            guild_id INTEGER,
+            bucket INTEGER,
+            PRIMARY KEY (guild_id, bucket)
+        ) WITHOUT ROWID
+    """
+    )
+    rows = cursor.connection.execute(
+        "SELECT guild_id, content FROM messages ORDER BY message_id"
+    )
+    for guild_id, content in rows:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO MessageBuckets (guild_id, bucket) VALUES (?, ?)",
+            [(guild_id, bucket) for bucket in content_buckets(content or "")],
+        )
+
+
+def add_message_sample_keys(cursor: sqlite3.Cursor):
+    # Retention keeps the messages with the smallest random keys per guild and
+    # per author, a bottom-k sample that stays uniform as new rows come in.
+    cursor.execute("ALTER TABLE messages ADD COLUMN sample_key INTEGER")
+    cursor.execute("UPDATE messages SET sample_key = random()")
+    cursor.execute("DROP INDEX IF EXISTS messages_by_guild")
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS messages_by_guild_sample
+        ON messages (guild_id, sample_key)
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS messages_by_author_sample
+        ON messages (guild_id, author_id, sample_key)
+    """
+    )
+    cursor.execute("ANALYZE")
+
+
+def add_question_state(cursor: sqlite3.Cursor):
+    # Open questions and the attempts on them, so buttons keep working
+    # across restarts.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS questions (
+            message_id INTEGER PRIMARY KEY,
+            channel_id INTEGER,
+            guild_id INTEGER,
+            correct_id INTEGER,
+            content TEXT,
+            choices TEXT,
+            expires_at REAL
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS question_attempts (
+            message_id INTEGER,
+            player_id INTEGER,
+            tries INTEGER,
+            solved INTEGER,
+            PRIMARY KEY (message_id, player_id)
+        ) WITHOUT ROWID
+    """
+    )
+
+
+def add_message_search(cursor: sqlite3.Cursor):
+    # Full-text index over messages for keyword questions. It reads the text
+    # from messages instead of keeping a copy, and indexes guild_id as a
+    # token so a search is limited to one guild inside the index. MessageDAO
+    # updates it along with messages, in batches, which is several times
+    # faster than triggers doing it row by row.
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5 (
+            content,
+            guild_id,
+            content = 'messages',
+            content_rowid = 'message_id'
+        )
+    """
+    )
+    cursor.execute("INSERT INTO message_search (message_search) VALUES ('rebuild')")
+
+
+def add_guild_players(cursor: sqlite3.Cursor):
+    # Scores per guild, with the player's name so players who only guess and
+    # never posted still show up. Global scores are copied to every guild the
+    # player posted in, which is where !scores showed them until now.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS GuildPlayers (
+            guild_id INTEGER,
+            player_id INTEGER,
+            name TEXT,
+            score INTEGER,
+            total_tries INTEGER,
+            average_guess REAL
+                GENERATED ALWAYS AS (CAST(total_tries AS REAL) / score) VIRTUAL,
+            PRIMARY KEY (guild_id, player_id)
+        ) WITHOUT ROWID
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS GuildPlayers_by_average_guess
+        ON GuildPlayers (guild_id, average_guess, player_id)
+    """
+    )
+    cursor.execute(
+        """
+        INSERT OR IGNORE INTO GuildPlayers (guild_id, player_id, name, score, total_tries)
+        SELECT ga.guild_id, p.player_id, a.display_name, p.score, p.total_tries
+        FROM players p
+        INNER JOIN GuildAuthors ga ON ga.author_id = p.player_id
+        INNER JOIN authors a ON a.author_id = p.player_id
+        WHERE p.score > 0
+    """
+    )
+
+
+def drop_global_players(cursor: sqlite3.Cursor):
+    # Scores live in GuildPlayers since add_guild_players copied them over.
+    cursor.execute("DROP INDEX IF EXISTS players_by_average_guess")
+    cursor.execute("DROP TABLE IF EXISTS players")
+
+
+MIGRATIONS: list[Callable[[sqlite3.Cursor], None]] = [
+    create_base_schema,
+    add_channel_checkpoints,
+    add_hot_query_indexes,
+    add_message_buckets,
+    add_message_sample_keys,
+    add_question_state,
+    add_message_search,
+    add_guild_players,
+    drop_global_players,
+]
+
+
+def get_schema_version(cursor: sqlite3.Cursor) -> int:
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migration(
+    cursor: sqlite3.Cursor, version: int, migration: Callable[[sqlite3.Cursor], None]
+):
+    # The migration and the version bump commit together, so an interrupted
+    # upgrade is retried from the same migration on the next start.
+    cursor.execute("BEGIN")
+    migration(cursor)
+    cursor.execute(f"PRAGMA user_version = {version}")
+
+
+def migrate(storage: Storage) -> int:
+    version = storage.setup(get_schema_version)
+    for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(
+            f"Migrating {storage.db_name} to version {version} ({migration.__name__})"
+        )
+        storage.setup(apply_migration, version, migration)
+    return version
@@ -0,0 +1,281 @@
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable
+import asyncio
+import time
+
+import discord
+
+from messagequizzer.config import *
+from messagequizzer.metrics import registry
+
+OUTBOUND_REQUESTS = registry.counter(
+    "messagequizzer_outbound_requests_total",
+    "Messages sent or edited by the outbound scheduler, by kind.",
+)
+OUTBOUND_RATE_LIMITS = registry.counter(
+    "messagequizzer_outbound_rate_limits_total",
+    "Outbound requests answered with a 429, by kind.",
+)
+OUTBOUND_COALESCED = registry.counter(
+    "messagequizzer_outbound_coalesced_total",
+    "Announcements sent as part of another announcement's message.",
+)
+OUTBOUND_WAIT = registry.histogram(
+    "messagequizzer_outbound_wait_seconds",
+    "Time outbound requests spent queued, by kind.",
+)
+
+
+class RateWindow:
+    # Up to rate requests in any period seconds. A bucket refilled
+    # continuously would let almost twice that through in one window.
+    __slots__ = ("rate", "period", "sent", "paused_until")
+
+    def __init__(self, rate: float, period: float):
+        self.rate = int(rate)
+        self.period = period
+        self.sent: deque[float] = deque()
+        self.paused_until = 0.0
+
+    def expire(self, now: float) -> None:
+        while self.sent and self.sent[0] <= now - self.period:
+            self.sent.popleft()
+
+    def delay(self, reserve: int = 0) -> float:
+        # Seconds until a request can be made with reserve requests left over.
+        now = time.monotonic()
+        self.expire(now)
+        delay = max(0.0, self.paused_until - now)
+        excess = len(self.sent) + 1 + min(reserve, self.rate - 1) - self.rate
+        if excess > 0:
+            delay = max(delay, self.sent[excess - 1] + self.period - now)
+        return delay
+
+    def take(self) -> None:
+        self.sent.append(time.monotonic())
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def clears_in(self) -> float:
+        # Seconds until no earlier request limits the next ones.
+        now = time.monotonic()
+        self.expire(now)
+        cleared_at = self.sent[-1] + self.period if self.sent else now
+        return max(0.0, cleared_at - now, self.paused_until - now)
+
+
+class ChannelQueue:
+    # Work for one channel, served in order of priority: replies to commands,
+    # then answer announcements, then edits closing questions.
+    __slots__ = (
+        "window",
+        "channel",
+        "replies",
+        "announcements",
+        "announced_at",
+        "edits",
+        "in_flight",
+        "wakeup",
+        "task",
+    )
+
+    def __init__(self, window: RateWindow):
+        self.window = window
+        self.channel: discord.abc.Messageable | None = None  # for announcements
+        self.replies: deque[tuple[Any, dict, asyncio.Future, float]] = deque()
+        self.announcements: list[str] = []
+        self.announced_at = 0.0
+        self.edits: OrderedDict[int, tuple[Any, dict, asyncio.Future, float]] = (
+            OrderedDict()
+        )
+        self.in_flight = False
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self.replies or self.announcements or self.edits)
+
+    def __len__(self) -> int:
+        return len(self.replies) + bool(self.announcements) + len(self.edits)
+
+    async def wait(self, timeout: float) -> None:
+        # Returns early when new work is queued, which may go out sooner.
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class OutboundScheduler:
+    # Sends and edits messages through one queue per channel, keeping to
+    # Discord's per-channel and global rate limits before it hits them rather
+    # than after. Announcements that queue up while a channel waits are sent
+    # as one message, and edits closing questions go out in the order the
+    # questions expired, leaving edit_reserve requests of every window to
+    # replies so a burst of timeouts does not hold up the next command.
+    def __init__(
+        self,
+        channel_rate: float = OUTBOUND_CHANNEL_RATE,
+        channel_period: float = OUTBOUND_CHANNEL_PERIOD,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        edit_reserve: int = OUTBOUND_EDIT_RESERVE,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self.channel_rate = channel_rate
+        self.channel_period = channel_period
+        self.global_window = RateWindow(global_rate, 1)
+        self.edit_reserve = edit_reserve
+        self.max_retries = max_retries
+        self.channels: dict[int, ChannelQueue] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.channels.values())
+
+    def queue(self, channel_id: int) -> ChannelQueue:
+        queue = self.channels.get(channel_id)
+        if queue is None:
+            queue = ChannelQueue(RateWindow(self.channel_rate, self.channel_period))
+            self.channels[channel_id] = queue
+        if queue.task is None:
+            queue.task = asyncio.create_task(self.run_channel(channel_id, queue))
+        queue.wakeup.set()
+        return queue
+
+    async def send(self, channel: discord.abc.Messageable, **kwargs) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.queue(channel.id).replies.append(
+            (channel, kwargs, future, time.monotonic())
+        )
+        return await future
+
+    def announce(self, channel: discord.abc.Messageable, line: str) -> None:
+        queue = self.queue(channel.id)
+        queue.channel = channel
+        if not queue.announcements:
+            queue.announced_at = time.monotonic()
+        queue.announcements.append(line)
+
+    def edit(self, message: discord.PartialMessage, **kwargs) -> asyncio.Future:
+        # A newer edit of a queued message replaces the older one in its place.
+        queue = self.queue(message.channel.id)
+        queued = queue.edits.get(message.id)
+        if queued is None:
+            future = asyncio.get_running_loop().create_future()
+            queued_at = time.monotonic()
+        else:
+            _, _, future, queued_at = queued
+        queue.edits[message.id] = (message, kwargs, future, queued_at)
+        return future
+
+    async def run_channel(self, channel_id: int, queue: ChannelQueue) -> None:
+        # Lives until the queue is empty and its window has passed, so the
+        # window is not forgotten while it still limits the channel.
+        try:
+            while queue or queue.window.clears_in() > 0:
+                if not queue:
+                    await queue.wait(queue.window.clears_in())
+                    continue
+                reserve = self.edit_reserve
+                if queue.replies or queue.announcements:
+                    reserve = 0
+                delay = max(
+                    queue.window.delay(reserve), self.global_window.delay(reserve)
+                )
+                if delay > 0:
+                    await queue.wait(delay)
+                    continue
+                queue.window.take()
+                self.global_window.take()
+                queue.in_flight = True
+                try:
+                    await self.run_next(queue)
+                finally:
+                    queue.in_flight = False
+        finally:
+            queue.task = None
+            if not queue and self.channels.get(channel_id) is queue:
+                del self.channels[channel_id]
+
+    async def run_next(self, queue: ChannelQueue) -> None:
+        future = None
+        if queue.replies:
+            kind = "reply"
+            channel, kwargs, future, queued_at = queue.replies.popleft()
+            request = lambda: channel.send(**kwargs)
+        elif queue.announcements:
+            kind = "announcement"
+            lines = take_lines(queue.announcements, MESSAGE_MAX_LENGTH)
+            OUTBOUND_COALESCED.inc(len(lines) - 1)
+            channel, queued_at = queue.channel, queue.announced_at
+            queue.announced_at = time.monotonic()
+            request = lambda: channel.send(content="\n".join(lines))
+        else:
+            kind = "edit"
+            _, (message, kwargs, future, queued_at) = queue.edits.popitem(last=False)
+            request = lambda: message.edit(**kwargs)
+        OUTBOUND_WAIT.observe(time.monotonic() - queued_at, kind=kind)
+        try:
+            result = await self.request(queue, kind, request)
+        except Exception as exception:
+            if future is None:
+                print(f"Could not send announcements to {channel.id}: {exception!r}")
+            elif not future.done():
+                future.set_exception(exception)
+        else:
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    async def request(
+        self, queue: ChannelQueue, kind: str, request: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        for attempt in range(self.max_retries + 1):
+            OUTBOUND_REQUESTS.inc(kind=kind)
+            try:
+                return await request()
+            except (discord.RateLimited, discord.HTTPException) as exception:
+                # discord.py waits out short rate limits itself; it raises
+                # RateLimited for longer ones, and a 429 once it gave up.
+                if isinstance(exception, discord.HTTPException):
+                    if exception.status != 429:
+                        raise
+                    retry_after = queue.window.period
+                else:
+                    retry_after = exception.retry_after
+                if attempt == self.max_retries:
+                    raise
+                OUTBOUND_RATE_LIMITS.inc(kind=kind)
+                queue.window.pause(retry_after)
+                await asyncio.sleep(retry_after)
+
+    async def stop(self, timeout: float = OUTBOUND_STOP_TIMEOUT) -> None:
+        # Queued work gets timeout seconds to go out; what is left is dropped
+        # and its waiters are cancelled.
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(
+            queue or queue.in_flight for queue in self.channels.values()
+        ):
+            await asyncio.sleep(0.1)
+        for queue in list(self.channels.values()):
+            if queue.task is not None:
+                queue.task.cancel()
+                try:
+                    await queue.task
+                except asyncio.CancelledError:
+                    pass
+            for _, _, future, _ in [*queue.replies, *queue.edits.values()]:
+                future.cancel()
+        self.channels.clear()
+
+
+def take_lines(lines: list[str], max_length: int) -> list[str]:
+    # Removes and returns the first lines that fit in one message together.
+    count = 1
+    length = len(lines[0])
+    while count < len(lines) and length + 1 + len(lines[count]) <= max_length:
+        length += 1 + len(lines[count])
+        count += 1
+    taken = lines[:count]
+    del lines[:count]
+    return taken
@@ -0,0 +1,223 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+import asyncio
+import time
+
+from messagequizzer.cache import TTLCache
+from messagequizzer.config import *
+from messagequizzer.database import Author, Message, OpenQuestion, QuestionDAO
+from messagequizzer.metrics import registry
+from messagequizzer.timers import TimerWheel
+
+QUESTIONS = registry.counter(
+    "messagequizzer_questions_total",
+    "Questions taken from the prefetch queues, by result.",
+)
+
+
+@dataclass
+class PreparedQuestion:
+    message: Message
+    correct_author: Author
+    choices: list[Author]  # shuffled, correct author included
+
+
+class QuestionQueue:
+    # Keeps up to size prepared questions per guild and tops them up in the
+    # background after every pop, so a guess only takes one off the front.
+    # Questions are checked when popped and dropped if they went stale.
+    def __init__(
+        self,
+        prepare: Callable[[int], Awaitable[PreparedQuestion | None]],
+        is_current: Callable[[PreparedQuestion], bool],
+        size: int = QUESTION_QUEUE_SIZE,
+        max_guilds: int = QUESTION_QUEUE_MAX_GUILDS,
+    ):
+        self.prepare = prepare
+        self.is_current = is_current
+        self.size = size
+        self.max_guilds = max_guilds
+        self.queues: OrderedDict[int, deque[tuple[int, PreparedQuestion]]] = (
+            OrderedDict()
+        )
+        self.generations: dict[int, int] = {}
+        self.refills: dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def pop(self, guild_id: int) -> PreparedQuestion | None:
+        queue = self.get_queue(guild_id)
+        question = None
+        while queue and question is None:
+            generation, candidate = queue.popleft()
+            if self.is_valid(guild_id, generation, candidate):
+                question = candidate
+            else:
+                QUESTIONS.inc(result="stale")
+        self.refill(guild_id)
+        if question is not None:
+            QUESTIONS.inc(result="hit")
+            return question
+        QUESTIONS.inc(result="miss")
+        return await self.prepare(guild_id)
+
+    def get_queue(self, guild_id: int) -> deque[tuple[int, PreparedQuestion]]:
+        queue = self.queues.get(guild_id)
+        if queue is not None:
+            self.queues.move_to_end(guild_id)
+            return queue
+        queue = self.queues[guild_id] = deque()
+        while len(self.queues) > self.max_guilds:
+            evicted_id, _ = self.queues.popitem(last=False)
+            refill = self.refills.pop(evicted_id, None)
+            if refill is not None:
+                refill.cancel()
+        return queue
+
+    def is_valid(
+        self, guild_id: int, generation: int, question: PreparedQuestion
+    ) -> bool:
+        return generation == self.generations.get(guild_id, 0) and self.is_current(
+            question
+        )
+
+    def refill(self, guild_id: int) -> None:
+        if guild_id in self.refills:
+            return
+        task = asyncio.create_task(self.fill(guild_id))
+        self.refills[guild_id] = task
+        task.add_done_callback(lambda _: self.refills.pop(guild_id, None))
+
+    async def fill(self, guild_id: int) -> None:
+        queue = self.queues.get(guild_id)
+        try:
+            while queue is self.queues.get(guild_id) and len(queue) < self.size:
+                generation = self.generations.get(guild_id, 0)
+                question = await self.prepare(guild_id)
+                if question is None:
+                    return
+                if generation == self.generations.get(guild_id, 0):
+                    queue.append((generation, question))
+        except Exception as exception:
+            print(f"Failed to prepare questions for {guild_id}: {exception!r}")
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        # Queued questions of the guild are dropped when they are popped, and
+        # ones being prepared right now are not queued at all.
+        self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+
+    async def stop(self) -> None:
+        refills = list(self.refills.values())
+        for refill in refills:
+            refill.cancel()
+        await asyncio.gather(*refills, return_exceptions=True)
+        self.queues.clear()
+
+
+@dataclass
+class Attempt:
+    tries: int = 0
+    solved: bool = False
+
+
+class QuestionStore:
+    # State of the questions that can still be answered, shared by all of
+    # their buttons. Questions and attempts live in the database so the
+    # buttons keep working across restarts. Attempts of open questions are
+    # kept in memory, loaded once on restore, and written by the game event
+    # buffer, so clicks never wait for the database. Every timeout is an
+    # entry in one timer wheel.
+    def __init__(
+        self,
+        question_dao: QuestionDAO,
+        on_expire: Callable[[OpenQuestion], Awaitable[None]],
+        timeout: float = QUESTION_TIMEOUT,
+        tick: float = QUESTION_TIMER_TICK,
+    ):
+        self.question_dao = question_dao
+        self.on_expire = on_expire
+        self.timeout = timeout
+        self.wheel = TimerWheel(self.schedule_expiry, tick)
+        self.questions = TTLCache(QUESTION_CACHE_TTL)
+        self.attempts: dict[tuple[int, int], Attempt] = {}
+        self.players: dict[int, set[int]] = {}
+        self.expiring: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.wheel)
+
+    async def open(self, question: OpenQuestion) -> None:
+        # Clicks may come in before the question is stored.
+        self.questions.put(question.message_id, question)
+        self.wheel.schedule(question.message_id, question.expires_at - time.time())
+        await self.question_dao.insert_question(question)
+
+    async def get(self, message_id: int) -> OpenQuestion | None:
+        question = await self.questions.get(
+            message_id, lambda: self.question_dao.get_question(message_id)
+        )
+        if question is None:
+            # Clicked before open() stored it, or already closed; not cached
+            # so a question that is being opened is found on the next click.
+            self.questions.invalidate(message_id)
+            return None
+        if question.expires_at <= time.time():
+            return None
+        return question
+
+    def get_attempt(self, message_id: int, player_id: int) -> Attempt:
+        key = (message_id, player_id)
+        attempt = self.attempts.get(key)
+        if attempt is None:
+            attempt = self.attempts[key] = Attempt()
+            self.players.setdefault(message_id, set()).add(player_id)
+        return attempt
+
+    async def restore(
+        self, shard_ids: list[int] | None = None, shard_count: int | None = None
+    ) -> None:
+        # Questions that expired while the bot was down expire on the first tick.
+        # Every process only restores the questions of the guilds it runs, so
+        # each question is closed once.
+        deadlines = await self.question_dao.get_question_deadlines(
+            shard_ids, shard_count
+        )
+        for message_id, expires_at in deadlines:
+            self.wheel.schedule(message_id, expires_at - time.time())
+        attempts = await self.question_dao.get_attempts(
+            [message_id for message_id, _ in deadlines]
+        )
+        for message_id, player_id, tries, solved in attempts:
+            self.attempts[(message_id, player_id)] = Attempt(tries, solved)
+            self.players.setdefault(message_id, set()).add(player_id)
+
+    def schedule_expiry(self, message_id: int) -> None:
+        task = asyncio.create_task(self.expire(message_id))
+        self.expiring.add(task)
+        task.add_done_callback(self.expiring.discard)
+
+    async def expire(self, message_id: int) -> None:
+        try:
+            question = await self.question_dao.get_question(message_id)
+            if question is not None:
+                await self.on_expire(question)
+            await self.question_dao.delete_question(message_id)
+        except Exception as exception:
+            print(f"Failed to close question {message_id}: {exception!r}")
+        self.questions.invalidate(message_id)
+        for player_id in self.players.pop(message_id, ()):
+            self.attempts.pop((message_id, player_id), None)
+
+    async def start(
+        self, shard_ids: list[int] | None = None, shard_count: int | None = None
+    ) -> None:
+        await self.restore(shard_ids, shard_count)
+        self.wheel.start()
+
+    async def stop(self) -> None:
+        # Open questions stay in the database and are picked up on restart.
+        await self.wheel.stop()
+        expiring = list(self.expiring)
+        await asyncio.gather(*expiring, return_exceptions=True)
@@ -0,0 +1,161 @@
+from typing import Awaitable, Callable
+import asyncio
+import sqlite3
+import time
+
+from messagequizzer.config import *
+from messagequizzer.database import GuildAuthorDAO, MessageBucketDAO, MessageDAO
+from messagequizzer.dedup import content_buckets
+from messagequizzer.metrics import registry
+from messagequizzer.migrations import DISCORD_EPOCH_MS
+from messagequizzer.backends import StorageHandle
+from messagequizzer.storage import Storage
+
+REMOVED_MESSAGES = registry.counter(
+    "messagequizzer_retention_removed_total",
+    "Messages deleted by the retention policy, by reason.",
+)
+
+
+class RetentionPolicy:
+    # Keeps every guild's messages within the configured caps. Rows over a cap
+    # are the ones with the largest sample keys, so what is left is a uniform
+    # sample of everything the guild or author ever posted. Deletes run in
+    # small batches between which the writer serves everything else, and the
+    # freed pages are returned with incremental vacuum steps.
+    def __init__(
+        self,
+        message_dao: MessageDAO,
+        message_bucket_dao: MessageBucketDAO,
+        guild_author_dao: GuildAuthorDAO,
+        interval: float = RETENTION_INTERVAL,
+        batch_size: int = RETENTION_BATCH_SIZE,
+        on_removed: Callable[[int], None] = lambda guild_id: None,
+    ):
+        self.message_dao = message_dao
+        self.message_bucket_dao = message_bucket_dao
+        self.guild_author_dao = guild_author_dao
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_removed = on_removed
+        self.task: asyncio.Task | None = None
+
+    async def compact(self, guild_ids: list[int] | None = None) -> int:
+        # Without guild ids every guild in the database is compacted; a shard
+        # process only passes the guilds of its own shards.
+        if guild_ids is None:
+            guild_ids = await self.guild_author_dao.get_guild_ids()
+        removed = 0
+        for guild_id in guild_ids:
+            removed += await self.compact_guild(guild_id)
+        # Guilds may share a storage; each is vacuumed once. Handles open their
+        # storage for every step, so one closed as idle meanwhile is reopened.
+        vacuumed = set()
+        for guild_id in guild_ids:
+            storage = self.message_dao.backend.guild(guild_id)
+            if storage.db_name not in vacuumed:
+                vacuumed.add(storage.db_name)
+                await self.vacuum(storage)
+        return removed
+
+    async def compact_guild(self, guild_id: int) -> int:
+        removed = 0
+        if RETENTION_MAX_AGE_DAYS is not None:
+            cutoff_ms = (time.time() - RETENTION_MAX_AGE_DAYS * 86400) * 1000
+            cutoff_id = max(0, int(cutoff_ms) - DISCORD_EPOCH_MS) << 22
+            removed += await self.remove_while(
+                guild_id,
+                "age",
+                lambda: self.message_dao.get_messages_before(
+                    guild_id, cutoff_id, self.batch_size
+                ),
+            )
+        if RETENTION_MAX_MESSAGES_PER_AUTHOR is not None:
+            removed += await self.remove_while(
+                guild_id,
+                "author_cap",
+                lambda: self.message_dao.get_excess_author_messages(
+                    guild_id, RETENTION_MAX_MESSAGES_PER_AUTHOR, self.batch_size
+                ),
+            )
+        if RETENTION_MAX_MESSAGES_PER_GUILD is not None:
+            removed += await self.remove_while(
+                guild_id,
+                "guild_cap",
+                lambda: self.message_dao.get_excess_guild_messages(
+                    guild_id, RETENTION_MAX_MESSAGES_PER_GUILD, self.batch_size
+                ),
+            )
+        if removed:
+            self.on_removed(guild_id)
+        return removed
+
+    async def remove_while(
+        self,
+        guild_id: int,
+        reason: str,
+        find_rows: Callable[[], Awaitable[list[tuple[int, str]]]],
+    ) -> int:
+        removed = 0
+        while rows := await find_rows():
+            buckets = await asyncio.to_thread(rows_buckets, rows)
+            async with self.message_dao.backend.guild(guild_id).transaction():
+                await self.message_dao.delete_messages(
+                    guild_id, [message_id for message_id, _ in rows]
+                )
+                await self.message_bucket_dao.release_buckets(guild_id, buckets)
+            REMOVED_MESSAGES.inc(len(rows), reason=reason)
+            removed += len(rows)
+        return removed
+
+    async def vacuum(self, storage: Storage | StorageHandle) -> None:
+        # One bounded step per write, so the writer is never held for long.
+        while await storage.write(vacuum_step, RETENTION_VACUUM_PAGES):
+            pass
+
+    async def run(self, guild_ids: Callable[[], list[int]] | None = None) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                removed = await self.compact(guild_ids() if guild_ids else None)
+            except Exception as exception:
+                print(f"Failed to apply the retention policy: {exception!r}")
+            else:
+                if removed:
+                    print(f"Retention removed {removed} messages")
+
+    def start(self, guild_ids: Callable[[], list[int]] | None = None) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(guild_ids))
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+def rows_buckets(rows: list[tuple[int, str]]) -> list[int]:
+    return [
+        bucket for _, content in rows for bucket in content_buckets(content or "")
+    ]
+
+
+def vacuum_step(cursor: sqlite3.Cursor, pages: int) -> bool:
+    # Returns whether another step would free more pages. Databases created
+    # before retention have no incremental vacuum; they are converted with one
+    # full VACUUM, but only once a good part of the file is free pages, since
+    # that rewrites the whole file.
+    freelist_count = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        remaining = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        return 0 < remaining < freelist_count
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    if freelist_count > page_count * RETENTION_FULL_VACUUM_FREE_RATIO:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    return False
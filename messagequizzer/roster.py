@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from typing import Callable
+import asyncio
+import random
+
+from messagequizzer.alias import AliasTable
+from messagequizzer.config import *
+from messagequizzer.database import Author, GuildAuthorDAO, MessageDAO, MixedAuthorDAO
+
+
+class GuildRoster:
+    __slots__ = (
+        "author_ids",
+        "positions",
+        "names",
+        "activity",
+        "activity_table",
+        "activity_total",
+        "activity_changes",
+        "mixes",
+        "mix_tables",
+    )
+
+    def __init__(self):
+        self.author_ids: list[int] = []
+        self.positions: dict[int, int] = {}
+        self.names: dict[int, str] = {}
+        self.activity: dict[int, int] = {}  # stored messages per author
+        self.activity_table: AliasTable | None = None
+        self.activity_total = 0  # weight of the table when it was built
+        self.activity_changes = 0  # messages and authors added since then
+        self.mixes: dict[int, dict[int, int]] = {}  # correct -> guessed -> times
+        self.mix_tables: dict[int, tuple[AliasTable, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.author_ids)
+
+    def add_author(self, author_id: int, name: str) -> None:
+        if author_id not in self.positions:
+            self.positions[author_id] = len(self.author_ids)
+            self.author_ids.append(author_id)
+            self.activity_changes += 1
+        self.names[author_id] = name
+
+    def add_messages(self, author_id: int, count: int) -> None:
+        self.activity[author_id] = self.activity.get(author_id, 0) + count
+        self.activity_changes += count
+
+    def add_mix(self, correct_id: int, guessed_id: int, times: int = 1) -> None:
+        guessed = self.mixes.setdefault(correct_id, {})
+        guessed[guessed_id] = guessed.get(guessed_id, 0) + times
+        # Only this author's table is stale; it is rebuilt on its next question.
+        self.mix_tables.pop(correct_id, None)
+
+    def get_activity_table(self) -> AliasTable:
+        # Authors are weighted by their stored messages, plus one so that
+        # authors whose messages are all gone can still come up. The table is
+        # rebuilt once the guild grew by DISTRACTOR_REBUILD_RATIO since then.
+        if (
+            self.activity_table is None
+            or self.activity_changes > DISTRACTOR_REBUILD_RATIO * self.activity_total
+        ):
+            weights = [
+                self.activity.get(author_id, 0) + 1 for author_id in self.author_ids
+            ]
+            self.activity_table = AliasTable(list(self.author_ids), weights)
+            self.activity_total = sum(weights)
+            self.activity_changes = 0
+        return self.activity_table
+
+    def get_mix_table(self, correct_id: int) -> tuple[AliasTable | None, int]:
+        entry = self.mix_tables.get(correct_id)
+        if entry is None:
+            guessed = self.mixes.get(correct_id)
+            if not guessed:
+                return None, 0
+            author_ids = list(guessed)
+            weights = [guessed[author_id] for author_id in author_ids]
+            entry = self.mix_tables[correct_id] = (
+                AliasTable(author_ids, weights),
+                sum(weights),
+            )
+        return entry
+
+    def sample(self, k: int, exclude_id: int) -> list[Author]:
+        # Distractors come from the authors the correct one was mistaken for
+        # before, more often the more mixes there were, and otherwise from
+        # the guild weighted by activity. Every draw is O(1) from an alias
+        # table and repeats are drawn again, so a question costs O(k).
+        chosen: list[int] = []
+        if len(self.author_ids) > k + 1:
+            activity_table = self.get_activity_table()
+            mix_table, mix_total = self.get_mix_table(exclude_id)
+            mix_share = mix_total / (mix_total + DISTRACTOR_MIX_PRIOR)
+            for _ in range(k * DISTRACTOR_MAX_DRAWS):
+                if len(chosen) == k:
+                    break
+                if mix_table is not None and random.random() < mix_share:
+                    author_id = mix_table.sample()
+                else:
+                    author_id = activity_table.sample()
+                if author_id != exclude_id and author_id not in chosen:
+                    chosen.append(author_id)
+        if len(chosen) < k:
+            # Small guilds, and guilds where a few authors write nearly
+            # everything, get the rest uniformly. Spare indices cover the
+            # excluded and already chosen authors.
+            count = len(self.author_ids)
+            indices = random.sample(range(count), k=min(k + 1 + len(chosen), count))
+            chosen.extend(
+                [
+                    self.author_ids[index]
+                    for index in indices
+                    if self.author_ids[index] != exclude_id
+                    and self.author_ids[index] not in chosen
+                ][: k - len(chosen)]
+            )
+        return [Author(author_id, self.names[author_id]) for author_id in chosen]
+
+
+class RosterCache:
+    # Least recently used guild rosters are evicted once more than max_guilds
+    # are cached, and reloaded from the database on their next question.
+    def __init__(
+        self,
+        guild_author_dao: GuildAuthorDAO,
+        message_dao: MessageDAO,
+        mixed_author_dao: MixedAuthorDAO,
+        max_guilds: int = ROSTER_MAX_GUILDS,
+    ):
+        self.guild_author_dao = guild_author_dao
+        self.message_dao = message_dao
+        self.mixed_author_dao = mixed_author_dao
+        self.max_guilds = max_guilds
+        self.rosters: OrderedDict[int, GuildRoster] = OrderedDict()
+        self.loading: dict[int, list[Callable[[GuildRoster], None]]] = {}
+        self.loads: dict[int, asyncio.Future] = {}
+
+    async def get(self, guild_id: int) -> GuildRoster:
+        roster = self.rosters.get(guild_id)
+        if roster is not None:
+            self.rosters.move_to_end(guild_id)
+            return roster
+        load = self.loads.get(guild_id)
+        if load is None:
+            load = asyncio.ensure_future(self.load(guild_id))
+            self.loads[guild_id] = load
+            load.add_done_callback(lambda _: self.loads.pop(guild_id, None))
+        return await asyncio.shield(load)
+
+    async def load(self, guild_id: int) -> GuildRoster:
+        # Changes made while the queries run are kept aside and applied after
+        # them, so they win over the possibly older rows they return.
+        self.loading[guild_id] = []
+        try:
+            authors, message_counts, mixes = await asyncio.gather(
+                self.guild_author_dao.get_authors_by_guild(guild_id),
+                self.message_dao.get_author_message_counts(guild_id),
+                self.mixed_author_dao.get_mixes_by_guild(guild_id),
+            )
+        finally:
+            changes = self.loading.pop(guild_id)
+        roster = GuildRoster()
+        for author in authors:
+            roster.add_author(author.author_id, author.name)
+        for author_id, count in message_counts.items():
+            roster.add_messages(author_id, count)
+        for mix in mixes:
+            roster.add_mix(mix.correct_id, mix.guessed_id, mix.times)
+        for change in changes:
+            change(roster)
+        self.rosters[guild_id] = roster
+        while len(self.rosters) > self.max_guilds:
+            self.rosters.popitem(last=False)
+        return roster
+
+    def peek(self, guild_id: int) -> GuildRoster | None:
+        return self.rosters.get(guild_id)
+
+    def update(self, guild_id: int, change: Callable[[GuildRoster], None]) -> None:
+        roster = self.rosters.get(guild_id)
+        if roster is not None:
+            change(roster)
+        elif guild_id in self.loading:
+            self.loading[guild_id].append(change)
+
+    def add_author(self, guild_id: int, author_id: int, name: str) -> None:
+        self.update(guild_id, lambda roster: roster.add_author(author_id, name))
+
+    def add_messages(self, guild_id: int, author_id: int, count: int) -> None:
+        self.update(guild_id, lambda roster: roster.add_messages(author_id, count))
+
+    def add_mix(self, guild_id: int, correct_id: int, guessed_id: int) -> None:
+        self.update(guild_id, lambda roster: roster.add_mix(correct_id, guessed_id))
+
+    def forget_guild(self, guild_id: int) -> None:
+        self.rosters.pop(guild_id, None)
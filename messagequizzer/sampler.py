@@ -0,0 +1,96 @@
+from array import array
+from collections import OrderedDict
+from typing import Iterable
+import random
+
+from messagequizzer.config import *
+
+
+class MessageSampler:
+    # Keeps a dense array of stored message ids per guild, so a uniformly random
+    # message is a single index into the array followed by a primary key lookup.
+    # Least recently sampled guilds are dropped once more than max_guilds are
+    # loaded, and loaded again on their next question.
+    def __init__(self, max_guilds: int = SAMPLER_MAX_GUILDS):
+        self.max_guilds = max_guilds
+        self.guild_message_ids: OrderedDict[int, array] = OrderedDict()
+        self.loading_message_ids: dict[int, list[int]] = {}
+        self.removed_message_ids: dict[int, set[int]] = {}
+
+    def is_loaded(self, guild_id: int) -> bool:
+        return guild_id in self.guild_message_ids
+
+    def begin_load(self, guild_id: int) -> None:
+        self.loading_message_ids[guild_id] = []
+        self.removed_message_ids[guild_id] = set()
+
+    def finish_load(self, guild_id: int, message_ids: Iterable[int]) -> None:
+        # Rows inserted while the load query was running may or may not be part
+        # of its result, so only append the ones it did not return.
+        # Rows deleted meanwhile are dropped the same way.
+        # A guild forgotten while it was loading stays forgotten.
+        if guild_id not in self.loading_message_ids:
+            return
+        loaded_message_ids = array("q", message_ids)
+        pending_message_ids = set(self.loading_message_ids.pop(guild_id))
+        removed_message_ids = self.removed_message_ids.pop(guild_id, set())
+        if pending_message_ids:
+            pending_message_ids.difference_update(loaded_message_ids)
+            loaded_message_ids.extend(pending_message_ids)
+        if removed_message_ids:
+            loaded_message_ids = without(loaded_message_ids, removed_message_ids)
+        self.guild_message_ids[guild_id] = loaded_message_ids
+        while len(self.guild_message_ids) > self.max_guilds:
+            self.guild_message_ids.popitem(last=False)
+
+    def cancel_load(self, guild_id: int) -> None:
+        self.loading_message_ids.pop(guild_id, None)
+        self.removed_message_ids.pop(guild_id, None)
+
+    def add_messages(self, guild_id: int, message_ids: Iterable[int]) -> None:
+        # Guilds that were never loaded pick up new rows on their first load.
+        if guild_id in self.guild_message_ids:
+            self.guild_message_ids[guild_id].extend(message_ids)
+        elif guild_id in self.loading_message_ids:
+            self.loading_message_ids[guild_id].extend(message_ids)
+
+    def remove_messages(self, guild_id: int, message_ids: Iterable[int]) -> None:
+        # Rebuilding a large guild's array for every batch of deleted rows would
+        # hold up the event loop each time, so the array is dropped instead and
+        # loaded again, once, the next time the guild is sampled.
+        if guild_id in self.guild_message_ids:
+            self.forget_guild(guild_id)
+        elif guild_id in self.removed_message_ids:
+            self.removed_message_ids[guild_id].update(message_ids)
+
+    def forget_guild(self, guild_id: int) -> None:
+        self.guild_message_ids.pop(guild_id, None)
+        self.cancel_load(guild_id)
+
+    def count(self, guild_id: int) -> int:
+        message_ids = self.guild_message_ids.get(guild_id)
+        if message_ids is None:
+            return 0
+        self.guild_message_ids.move_to_end(guild_id)
+        return len(message_ids)
+
+    def get_message_id(self, guild_id: int, index: int) -> int:
+        return self.guild_message_ids[guild_id][index]
+
+    def choose_message_id(self, guild_id: int) -> int | None:
+        message_ids = self.guild_message_ids.get(guild_id)
+        if not message_ids:
+            return None
+        self.guild_message_ids.move_to_end(guild_id)
+        return message_ids[random.randrange(len(message_ids))]
+
+
+def without(message_ids: array, removed_message_ids: set[int]) -> array:
+    return array(
+        "q",
+        (
+            message_id
+            for message_id in message_ids
+            if message_id not in removed_message_ids
+        ),
+    )
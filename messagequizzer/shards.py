@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import signal
+
+from messagequizzer.bot import bot
+from messagequizzer.config import *
+from messagequizzer.database import backend, close_database, init_database
+from messagequizzer.writer import serve_writer
+
+
+def run_bot(token: str, shard_count: int | None = None) -> None:
+    bot.shard_count = shard_count
+    init_database()
+    try:
+        bot.run(token)
+    finally:
+        close_database()
+
+
+def run_sharded(token: str, shard_count: int, processes: int) -> None:
+    # One writer process owns the writes to the shared database; every shard
+    # process runs an interleaved slice of the shards with its own buffers and
+    # caches, which only ever hold the guilds of those shards. With the sharded
+    # storage backend, guild files are written by the process of their guilds.
+    context = multiprocessing.get_context("spawn")
+    address = (WRITER_HOST, WRITER_PORT)
+    authkey = os.urandom(32)
+    ready = context.Event()
+    writer = context.Process(
+        target=run_writer,
+        args=(backend.shared.db_name, address, authkey, ready),
+        name="writer",
+    )
+    writer.start()
+    while not ready.wait(timeout=1):
+        if not writer.is_alive():
+            raise RuntimeError("The writer service failed to start")
+
+    shard_processes = []
+    for index in range(processes):
+        shard_ids = list(range(index, shard_count, processes))
+        process = context.Process(
+            target=run_shards,
+            args=(token, shard_ids, shard_count, address, authkey, index),
+            name=f"shards-{index}",
+        )
+        process.start()
+        shard_processes.append(process)
+    try:
+        for process in shard_processes:
+            process.join()
+    finally:
+        # Ctrl+C reaches the whole process group; the shards flush their
+        # buffers on the way out, so the writer is stopped only after them.
+        for process in shard_processes:
+            process.join()
+        writer.terminate()
+        writer.join()
+
+
+def run_writer(
+    db_name: str, address: tuple[str, int], authkey: bytes, ready
+) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve_writer(db_name, address, authkey, ready)
+
+
+def run_shards(
+    token: str,
+    shard_ids: list[int],
+    shard_count: int,
+    address: tuple[str, int],
+    authkey: bytes,
+    index: int,
+) -> None:
+    print(f"Starting shards {shard_ids} of {shard_count}")
+    backend.use_writer_service(address, authkey)
+    bot.shard_ids = shard_ids
+    if bot.metrics_port is not None:
+        bot.metrics_port += index
+    try:
+        run_bot(token, shard_count)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,334 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from multiprocessing.connection import Client
+from typing import Any, Callable, Iterable
+import asyncio
+import functools
+import queue
+import sqlite3
+import threading
+
+from messagequizzer.metrics import QUERIES
+
+
+class Transaction:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.operations = queue.SimpleQueue()
+        self.failed = False
+        self.closed = False
+
+
+class RemoteWriter:
+    # Connection to the writer service of a sharded deployment. It is only used
+    # from the writer thread, so requests and their replies never interleave.
+    def __init__(self, address: tuple[str, int], authkey: bytes):
+        self.conn = Client(address, authkey=authkey)
+
+    def request(self, *message) -> Any:
+        self.conn.send(message)
+        status, value = self.conn.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def close(self):
+        self.conn.close()
+
+
+class Storage:
+    # Owns every connection to the database file. Writes are serialized on a
+    # single writer thread, reads are spread over a small pool of read-only
+    # connections, and nothing touches the file until open() is called.
+    # With a writer service, writes are sent to the process that owns the
+    # write connection instead, and only the reads stay local.
+    #
+    # An in-memory storage is a shared-cache memory database that lives as long
+    # as the writer connection. Its readers read uncommitted, since the shared
+    # cache would otherwise block them for the whole of every write.
+    def __init__(
+        self,
+        db_name: str,
+        read_connections: int = 4,
+        *,
+        memory: bool = False,
+        cache_size_kib: int = 64 * 1024,
+        mmap_size: int = 256 * 1024 * 1024,
+        busy_timeout_ms: int = 5000,
+        cached_statements: int = 256,
+    ):
+        self.db_name = db_name
+        self.memory = memory
+        self.read_connections = read_connections
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.writer_address: tuple[str, int] | None = None
+        self.writer_authkey: bytes | None = None
+        self.remote: RemoteWriter | None = None
+        self.writer: ThreadPoolExecutor | None = None
+        self.readers: ThreadPoolExecutor | None = None
+        self.local = threading.local()
+        self.connections: list[sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+        self.current_transaction: ContextVar[Transaction | None] = ContextVar(
+            "current_transaction", default=None
+        )
+        self.pending = 0  # reads, writes and transactions not finished yet
+
+    @property
+    def is_open(self) -> bool:
+        return self.writer is not None
+
+    @property
+    def is_idle(self) -> bool:
+        return self.pending == 0
+
+    def use_writer_service(self, address: tuple[str, int], authkey: bytes):
+        if self.is_open:
+            raise RuntimeError(f"Storage for {self.db_name} is already open")
+        self.writer_address = address
+        self.writer_authkey = authkey
+
+    def open(self):
+        if self.is_open:
+            return
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="storage-writer"
+        )
+        self.readers = ThreadPoolExecutor(
+            max_workers=self.read_connections, thread_name_prefix="storage-reader"
+        )
+        if self.writer_address is not None:
+            self.writer.submit(self.connect_writer_service).result()
+            return
+        # WAL is persistent, so switching once lets readers run beside the writer.
+        self.writer.submit(self.connection, False).result()
+
+    def connect_writer_service(self):
+        self.remote = RemoteWriter(self.writer_address, self.writer_authkey)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        if self.remote is not None:
+            self.remote.close()
+            self.remote = None
+        self.writer = None
+        self.readers = None
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    def connect(self, read_only: bool) -> sqlite3.Connection:
+        if self.memory:
+            return self.connect_memory(read_only)
+        conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        if not read_only:
+            # Only takes effect on a new database; retention converts old ones.
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = {-self.cache_size_kib}")
+        conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def connect_memory(self, read_only: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"file:{self.db_name}?mode=memory&cache=shared",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        if read_only:
+            conn.execute("PRAGMA read_uncommitted = ON")
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def connection(self, read_only: bool) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.connect(read_only)
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    def run_write(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        if self.remote is not None:
+            return self.remote.request("write", fn, args)
+        conn = self.connection(False)
+        cursor = conn.cursor()
+        try:
+            result = fn(cursor, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def run_read(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        cursor = self.connection(True).cursor()
+        try:
+            return fn(cursor, *args)
+        finally:
+            cursor.close()
+
+    def run_transaction(self, transaction: Transaction):
+        # Holds the writer thread until the owning task leaves its transaction
+        # block, running that task's writes without committing in between.
+        if self.remote is not None:
+            self.remote.request("begin")
+            self.run_operations(
+                transaction,
+                lambda fn, args: self.remote.request("operation", fn, args),
+            )
+            self.remote.request("rollback" if transaction.failed else "commit")
+            return
+        conn = self.connection(False)
+        cursor = conn.cursor()
+        try:
+            self.run_operations(transaction, lambda fn, args: fn(cursor, *args))
+            if transaction.failed:
+                conn.rollback()
+            else:
+                conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def run_operations(
+        transaction: Transaction, run: Callable[[Callable, tuple], Any]
+    ):
+        while True:
+            operation = transaction.operations.get()
+            if operation is None:
+                break
+            fn, args, future = operation
+            try:
+                result = run(fn, args)
+            except BaseException as exception:
+                transaction.failed = True
+                transaction.loop.call_soon_threadsafe(
+                    set_future_exception, future, exception
+                )
+            else:
+                transaction.loop.call_soon_threadsafe(
+                    set_future_result, future, result
+                )
+
+    def executor(self, read_only: bool) -> ThreadPoolExecutor:
+        if not self.is_open:
+            raise RuntimeError(f"Storage for {self.db_name} is not open")
+        return self.readers if read_only else self.writer
+
+    @asynccontextmanager
+    async def transaction(self):
+        current = self.current_transaction.get()
+        if current is not None and not current.closed:
+            yield
+            return
+        QUERIES.inc(kind="transaction")
+        loop = asyncio.get_running_loop()
+        transaction = Transaction(loop)
+        done = loop.run_in_executor(
+            self.executor(False), self.run_transaction, transaction
+        )
+        token = self.current_transaction.set(transaction)
+        self.pending += 1
+        try:
+            yield
+        except BaseException:
+            transaction.failed = True
+            raise
+        finally:
+            self.current_transaction.reset(token)
+            transaction.closed = True
+            transaction.operations.put(None)
+            try:
+                await done
+            finally:
+                self.pending -= 1
+
+    async def write(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        QUERIES.inc(kind="write")
+        transaction = self.current_transaction.get()
+        if transaction is not None and not transaction.closed:
+            future = transaction.loop.create_future()
+            transaction.operations.put((fn, args, future))
+            return await future
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                self.executor(False), functools.partial(self.run_write, fn, *args)
+            )
+        finally:
+            self.pending -= 1
+
+    async def read(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        QUERIES.inc(kind="read")
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                self.executor(True), functools.partial(self.run_read, fn, *args)
+            )
+        finally:
+            self.pending -= 1
+
+    # Writes are plain functions rather than lambdas, so they can be sent to a
+    # writer service.
+    async def execute(self, query: str, params: Iterable = ()) -> int:
+        return await self.write(execute_query, query, params)
+
+    async def executemany(self, query: str, values: Iterable[Iterable]) -> int:
+        return await self.write(execute_many, query, list(values))
+
+    async def fetchone(self, query: str, params: Iterable = ()) -> tuple | None:
+        return await self.read(lambda cursor: cursor.execute(query, params).fetchone())
+
+    async def fetchall(self, query: str, params: Iterable = ()) -> list[tuple]:
+        return await self.read(lambda cursor: cursor.execute(query, params).fetchall())
+
+    def setup(self, fn: Callable[[sqlite3.Cursor], Any], *args) -> Any:
+        # Synchronous write used for schema setup before the event loop runs.
+        return self.executor(False).submit(self.run_write, fn, *args).result()
+
+
+def execute_query(cursor: sqlite3.Cursor, query: str, params: Iterable) -> int:
+    return cursor.execute(query, params).rowcount
+
+
+def execute_many(cursor: sqlite3.Cursor, query: str, values: list[Iterable]) -> int:
+    return cursor.executemany(query, values).rowcount
+
+
+def set_future_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def set_future_exception(future: asyncio.Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
@@ -0,0 +1,71 @@
+from typing import Callable, Hashable
+import asyncio
+import math
+import time
+
+
+class TimerWheel:
+    # A hashed timer wheel: one task ticks through the slots and expires the
+    # keys due in the current one, so any number of pending timeouts costs a
+    # dict entry each instead of a task each. Delays longer than a full turn
+    # wait the extra rounds in their slot.
+    def __init__(
+        self, on_expire: Callable[[Hashable], None], tick: float, slots: int = 512
+    ):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots: list[dict[Hashable, int]] = [{} for _ in range(slots)]
+        self.positions: dict[Hashable, int] = {}
+        self.current = 0
+        self.task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][key] = (ticks - 1) // len(self.slots)
+        self.positions[key] = slot
+
+    def cancel(self, key: Hashable) -> None:
+        slot = self.positions.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self) -> None:
+        self.current = (self.current + 1) % len(self.slots)
+        slot = self.slots[self.current]
+        expired = []
+        for key, rounds in slot.items():
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                expired.append(key)
+        for key in expired:
+            del slot[key]
+            del self.positions[key]
+            self.on_expire(key)
+
+    async def run(self) -> None:
+        # Ticks missed while the loop was busy are caught up at once.
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            while next_tick <= time.monotonic():
+                self.advance()
+                next_tick += self.tick
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,90 @@
+from multiprocessing.connection import Connection, Listener
+from multiprocessing.synchronize import Event
+from typing import Any, Callable
+import threading
+
+from messagequizzer.migrations import migrate
+from messagequizzer.storage import Storage
+
+
+def serve_writer(
+    db_name: str, address: tuple[str, int], authkey: bytes, ready: Event
+) -> None:
+    # Runs in its own process and owns the only write connection to the
+    # database; shard processes send it their writes and read the file directly.
+    storage = Storage(db_name, read_connections=1)
+    storage.open()
+    try:
+        migrate(storage)
+        with Listener(address, authkey=authkey) as listener:
+            print(f"Writer service listening on {address[0]}:{address[1]}")
+            ready.set()
+            while True:
+                conn = listener.accept()
+                threading.Thread(
+                    target=serve_client, args=(storage, conn), daemon=True
+                ).start()
+    finally:
+        storage.close()
+
+
+def serve_client(storage: Storage, conn: Connection) -> None:
+    writer = storage.executor(False)
+    with conn:
+        try:
+            while True:
+                request = conn.recv()
+                if request[0] == "write":
+                    _, fn, args = request
+                    future = writer.submit(storage.run_write, fn, *args)
+                    reply(conn, future.result)
+                elif request[0] == "begin":
+                    writer.submit(serve_transaction, storage, conn).result()
+                else:
+                    error = RuntimeError(f"Unknown request {request[0]!r}")
+                    send_reply(conn, "error", error)
+        except EOFError:
+            # The shard process went away, mid-transaction or not.
+            return
+
+
+def serve_transaction(storage: Storage, conn: Connection) -> None:
+    # Runs on the writer thread, which the client holds until it commits or
+    # rolls back, exactly like an in-process transaction.
+    db_conn = storage.connection(False)
+    cursor = db_conn.cursor()
+    send_reply(conn, "ok", None)
+    try:
+        while True:
+            request = conn.recv()
+            if request[0] == "operation":
+                _, fn, args = request
+                reply(conn, lambda: fn(cursor, *args))
+            elif request[0] == "commit":
+                reply(conn, db_conn.commit)
+                return
+            else:
+                reply(conn, db_conn.rollback)
+                return
+    except BaseException:
+        db_conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def reply(conn: Connection, call: Callable[[], Any]) -> None:
+    try:
+        value = call()
+    except Exception as exception:
+        send_reply(conn, "error", exception)
+    else:
+        send_reply(conn, "ok", value)
+
+
+def send_reply(conn: Connection, status: str, value: Any) -> None:
+    try:
+        conn.send((status, value))
+    except Exception as exception:
+        # Results and exceptions that cannot be pickled still get an answer.
+        conn.send(("error", RuntimeError(f"Unsendable reply: {exception!r}")))
@@ -1,4 +1,28 @@
-from messagequizzer.bot import bot
+import argparse
+
 from messagequizzer.bot_token import BOT_TOKEN
+from messagequizzer.config import SHARD_COUNT, SHARD_PROCESSES
+from messagequizzer.shards import run_bot, run_sharded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the MessageQuizzer bot.")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=SHARD_PROCESSES,
+        help="processes to spread the shards over, sharing one writer service",
+    )
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        if args.shards is None or args.shards < args.processes:
+            parser.error("--processes needs --shards set to at least as many shards")
+        run_sharded(BOT_TOKEN, args.shards, args.processes)
+    else:
+        run_bot(BOT_TOKEN, args.shards)
+
 
-bot.run(BOT_TOKEN)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import asyncio
+
+from messagequizzer.backends import MemoryBackend, ShardedBackend
+from messagequizzer.database import Message, MessageDAO
+from messagequizzer.retention import vacuum_step
+
+
+async def insert_guild_row(backend, guild_id: int, message_id: int) -> None:
+    await backend.guild(guild_id).execute(
+        "INSERT INTO messages (message_id, author_id, guild_id, content) VALUES (?, ?, ?, ?)",
+        (message_id, 1, guild_id, "hello"),
+    )
+
+
+async def count_guild_rows(backend, guild_id: int) -> int:
+    row = await backend.guild(guild_id).fetchone(
+        "SELECT count(*) FROM messages WHERE guild_id = ?", (guild_id,)
+    )
+    return row[0]
+
+
+def test_memory_backend_keeps_guilds_apart():
+    async def run():
+        backend = MemoryBackend()
+        backend.open()
+        try:
+            await insert_guild_row(backend, 1, 10)
+            await insert_guild_row(backend, 2, 20)
+            rows = await backend.guild(1).fetchall("SELECT message_id FROM messages")
+            assert rows == [(10,)]
+            assert sorted(h.db_name for h in backend.guild_storages()) == [
+                "guild-1",
+                "guild-2",
+            ]
+        finally:
+            backend.close()
+
+    asyncio.run(run())
+
+
+def test_memory_backend_dao_round_trip():
+    async def run():
+        backend = MemoryBackend()
+        backend.open()
+        try:
+            dao = MessageDAO(backend)
+            await dao.insert_messages([Message(i, 1, 7, f"m{i}") for i in range(5)])
+            assert await dao.get_message_count_by_guild_id(7) == 5
+            message = await dao.get_random_message_by_guild_id(7)
+            assert message.guild_id == 7
+        finally:
+            backend.close()
+
+    asyncio.run(run())
+
+
+def test_sharded_backend_closes_least_recently_used(tmp_path):
+    async def run():
+        backend = ShardedBackend(str(tmp_path), max_open=2)
+        backend.open()
+        try:
+            for guild_id in (1, 2, 3):
+                await insert_guild_row(backend, guild_id, guild_id * 10)
+            assert list(backend.storages) == ["guild-2.db", "guild-3.db"]
+            # Closed files are opened again with their rows.
+            assert await count_guild_rows(backend, 1) == 1
+            assert list(backend.storages) == ["guild-3.db", "guild-1.db"]
+        finally:
+            backend.close()
+
+    asyncio.run(run())
+
+
+def test_sharded_backend_keeps_storages_in_use_open(tmp_path):
+    async def run():
+        backend = ShardedBackend(str(tmp_path), max_open=1)
+        backend.open()
+        try:
+            async with backend.guild(1).transaction():
+                await insert_guild_row(backend, 1, 10)
+                await insert_guild_row(backend, 2, 20)
+                await insert_guild_row(backend, 3, 30)
+                assert "guild-1.db" in backend.storages
+                await insert_guild_row(backend, 1, 11)
+            assert await count_guild_rows(backend, 1) == 2
+            await count_guild_rows(backend, 2)
+            assert list(backend.storages) == ["guild-2.db"]
+        finally:
+            backend.close()
+
+    asyncio.run(run())
+
+
+def test_sharded_backend_handles_survive_eviction(tmp_path):
+    # Like retention vacuuming a guild's file while other guilds are used.
+    async def run():
+        backend = ShardedBackend(str(tmp_path), max_open=1)
+        backend.open()
+        try:
+            handle = backend.guild(1)
+            await insert_guild_row(backend, 1, 10)
+            for guild_id in (2, 3):
+                await insert_guild_row(backend, guild_id, guild_id * 10)
+                assert "guild-1.db" not in backend.storages
+                await handle.write(vacuum_step, 10)
+            assert await count_guild_rows(backend, 1) == 1
+        finally:
+            backend.close()
+
+    asyncio.run(run())
+
+
+def test_sharded_backend_opens_each_file_once(tmp_path):
+    async def run():
+        backend = ShardedBackend(str(tmp_path), shard_count=2)
+        backend.open()
+        try:
+            storages = await asyncio.gather(
+                *(backend.storage(backend.file_name(1 << 22)) for _ in range(5))
+            )
+            assert len({id(storage) for storage in storages}) == 1
+            await insert_guild_row(backend, 1 << 22, 1)
+            await insert_guild_row(backend, 3 << 22, 2)
+            assert await count_guild_rows(backend, 3 << 22) == 1
+            assert list(backend.storages) == ["shard-1.db"]
+        finally:
+            backend.close()
+
+    asyncio.run(run())